@@ -115,48 +115,101 @@ class Worker(threading.Thread):
 
 
 # ---------------------------------------------------------------------------
+class CityTemps:
+    """
+    Running count, mean, min, max and variance of one city's temperatures.
+    Uses Welford's method, so nothing but these numbers is kept however many
+    records are added. The caller holds the city's lock.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0       # sum of squared differences from the mean
+        self.min = None
+        self.max = None
+
+    def add(self, t):
+        self.count += 1
+        delta = t - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (t - self.mean)
+        if self.min is None or t < self.min:
+            self.min = t
+        if self.max is None or t > self.max:
+            self.max = t
+
+    def variance(self):
+        """ Population variance, 0.0 with fewer than 2 temperatures """
+        if self.count < 2:
+            return 0.0
+        return self.m2 / self.count
+
+
 class NOAA:
     """
-    NOAA stores temperature data per city in a thread-safe manner and can
-    compute average temperature for each city.
+    NOAA keeps a running summary of the temperatures of each city in a
+    thread-safe manner and can return the average temperature for each city.
+    Every city has its own lock, so workers adding records for different
+    cities don't wait for each other.
     """
 
     def __init__(self):
-        # city -> list of temperatures
+        # city -> CityTemps
         self._data = {}
-        # lock to protect _data
+        # city -> lock protecting that city's CityTemps
+        self._locks = {}
+        # only protects adding a city that isn't in CITIES
         self._lock = threading.Lock()
-        # initialize lists for each city for predictable ordering and presence
+        # initialize every city up front for predictable ordering and presence
         for city in CITIES:
-            self._data[city] = []
+            self._data[city] = CityTemps()
+            self._locks[city] = threading.Lock()
+
+    def _city(self, city):
+        """ Returns (CityTemps, lock) of city, adding it the first time it's seen """
+        if city not in self._data:
+            with self._lock:
+                if city not in self._data:
+                    self._locks[city] = threading.Lock()
+                    self._data[city] = CityTemps()
+        return self._data[city], self._locks[city]
 
     def add_record(self, city, date, temp):
         """
-        Store a single temperature reading for a city.
-        date included for completeness though not used in average calculation.
+        Add a single temperature reading to a city.
+        date included for completeness though not used in the summary.
         """
         # Ensure temp is float
         try:
             t = float(temp)
         except Exception:
-            # if temp is invalid, skip storing
+            # if temp is invalid, skip it
             return
-        with self._lock:
-            if city not in self._data:
-                self._data[city] = []
-            self._data[city].append(t)
+        temps, lock = self._city(city)
+        with lock:
+            temps.add(t)
 
     def get_temp_details(self, city):
         """
         Return the average temperature for the given city.
         If no data exists, returns 0.0
         """
-        with self._lock:
-            temps = self._data.get(city, [])
-            if not temps:
-                return 0.0
-            avg = sum(temps) / len(temps)
-            return avg
+        if city not in self._data:
+            return 0.0
+        temps, lock = self._city(city)
+        with lock:
+            return temps.mean
+
+    def get_temp_summary(self, city):
+        """
+        Return a dict with the count, average, min, max and variance of the
+        temperatures of the given city.
+        """
+        temps, lock = self._city(city)
+        with lock:
+            return {'count': temps.count, 'average': temps.mean, 'min': temps.min,
+                    'max': temps.max, 'variance': temps.variance()}
 
 
 # ---------------------------------------------------------------------------
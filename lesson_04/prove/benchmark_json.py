@@ -0,0 +1,78 @@
+"""
+Course: CSE 351
+Lesson Week: 4
+File: benchmark_json.py
+Purpose: Time how the weather server builds its JSON replies
+
+Compares the old way (an f-string that looks like a dict, ast.literal_eval()
+then json.dumps()) with what server.py does now for /record, /city and
+/end. Both must give the same text.
+
+    python benchmark_json.py --calls 100000
+"""
+
+import argparse
+import ast
+import json
+import timeit
+
+import server
+
+
+def record_old(name, date_str, temp):
+    data_str = '{' + \
+               f'"status":"OK", "city": "{name}", "date": "{date_str}", "temp": {temp}' + \
+               '}'
+    return json.dumps(ast.literal_eval(data_str))
+
+
+def record_new(name, date_str, temp):
+    return server.RECORD_JSON % (name, date_str, temp)
+
+
+def city_old(name, records):
+    data_str = '{' + \
+               f'"status":"OK", "city": "{name}", "records": {records}' + \
+               '}'
+    return json.dumps(ast.literal_eval(data_str))
+
+
+def city_new(name, records):
+    return json.dumps({'status': 'OK', 'city': name, 'records': records})
+
+
+def end_old(calls, threads, total_time, p50, p99):
+    data_str = '{' + \
+               f'"status":"OK", "api": {calls}, "threads": {threads}, "total_time": {total_time}, "calls_per_second": {calls / total_time}, ' + \
+               f'"p50": {p50}, "p99": {p99}' + \
+               '}'
+    return json.dumps(ast.literal_eval(data_str))
+
+
+def end_new(calls, threads, total_time, p50, p99):
+    return json.dumps({'status': 'OK', 'api': calls, 'threads': threads, 'total_time': total_time,
+                       'calls_per_second': calls / total_time, 'p50': p50, 'p99': p99})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ast.literal_eval vs direct JSON replies')
+    parser.add_argument('--calls', type=int, default=100000)
+    args = parser.parse_args()
+
+    cases = (
+        ('/record', record_old, record_new, ('chicago', '04-16 00:07:29', 17)),
+        ('/record (float)', record_old, record_new, ('chicago', '04-16 00:07:29', -2.5)),
+        ('/city', city_old, city_new, ('chicago', 10000)),
+        ('/end', end_old, end_new, (50012, 200, 141.05053043365479, 0.1004, 0.1041)),
+    )
+
+    print(f'{"reply":<16} {"old (us)":>10} {"new (us)":>10} {"speedup":>8}')
+    for title, old, new, values in cases:
+        assert old(*values) == new(*values), title
+        old_time = timeit.timeit(lambda: old(*values), number=args.calls) / args.calls
+        new_time = timeit.timeit(lambda: new(*values), number=args.calls) / args.calls
+        print(f'{title:<16} {old_time * 1e6:>10.2f} {new_time * 1e6:>10.2f} {old_time / new_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
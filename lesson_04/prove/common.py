@@ -12,9 +12,11 @@ Common data for the assignment
 """
 
 import time
+import random
 import threading
 import json
 import requests
+import requests.adapters
 
 from cse351 import *
 
@@ -33,28 +35,90 @@ CITIES = (
     'phoenix',
 )
 
+# Connection pool and retry policy used by get_data_from_server()
+# Pooled connections are only reused when the server runs with --keep-alive
+MAX_CONNECTIONS = 256       # connections kept open, use at least the number of worker threads
+RETRIES = 10
+BACKOFF_START = 0.01        # seconds, doubled after every failed attempt
+BACKOFF_MAX = 1.0
+
+_adapter = None
+_adapter_lock = threading.Lock()
+_thread_data = threading.local()
+
+# ----------------------------------------------------------------------------
+def configure_client(max_connections=None, retries=None, backoff_start=None, backoff_max=None):
+    """ Change the pool size and retry policy, call this before starting any threads """
+    global MAX_CONNECTIONS, RETRIES, BACKOFF_START, BACKOFF_MAX, _adapter
+
+    if max_connections is not None:
+        MAX_CONNECTIONS = max_connections
+    if retries is not None:
+        RETRIES = retries
+    if backoff_start is not None:
+        BACKOFF_START = backoff_start
+    if backoff_max is not None:
+        BACKOFF_MAX = backoff_max
+
+    with _adapter_lock:
+        _adapter = None
+
+# ----------------------------------------------------------------------------
+def _get_session():
+    """ Returns this thread's Session, all of the Sessions share one connection pool """
+    global _adapter
+
+    adapter = _adapter
+    if adapter is None:
+        with _adapter_lock:
+            if _adapter is None:
+                _adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONNECTIONS)
+            adapter = _adapter
+
+    if getattr(_thread_data, 'adapter', None) is not adapter:
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _thread_data.session = session
+        _thread_data.adapter = adapter
+
+    return _thread_data.session
+
 # ----------------------------------------------------------------------------
 def get_data_from_server(url):
-    retries = 50
-    delay = 0.01 # seconds
-    for i in range(retries):
+    session = _get_session()
+    delay = BACKOFF_START
+    for i in range(RETRIES):
         try:
-            response = requests.get(url, timeout=10)
+            response = session.get(url, timeout=10)
             response.raise_for_status()
             if response.status_code == 200 and response.json() is not None:
                 return response.json()
             break
 
-        except requests.exceptions.ConnectionError as e:
-            if i < retries - 1:
-                time.sleep(delay)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            if i < RETRIES - 1:
+                # exponential backoff, with jitter so waiting threads don't all retry together
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, BACKOFF_MAX)
             else:
                 print("Max retries reached. Failing.")
                 
-        except requests.exceptions.Timeout:
-            ...
-            
         except requests.exceptions.RequestException as e:
             break
 
-    return None
\ No newline at end of file
+    return None
+
+# ----------------------------------------------------------------------------
+def get_pages_from_server(url):
+    """ Yields each JSON line of a /stream reply as soon as it arrives """
+    session = _get_session()
+    try:
+        with session.get(url, stream=True, timeout=10) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    except requests.exceptions.RequestException as e:
+        return
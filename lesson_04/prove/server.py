@@ -27,6 +27,12 @@ API
 /end
 /city/{city}
 /record/{city}/{recno}`
+/records/{city}/{start}/{count}         up to MAX_RANGE records in one reply, one latency charge
+/stream/{city}/{start}/{count}/{page}   the same records streamed as one JSON line per page of
+                                        {page} records, one latency charge per page
+/stats          every request since /start, a latency histogram and the
+                concurrency over time, not counted as an API call
+                (with --workers, only the requests of the worker that answers)
 
 """
 
@@ -37,17 +43,36 @@ import json
 import time
 import random
 import threading
-import ast
+import atexit
+import bisect
+import argparse
+import collections
+from array import array
+import math
+import mmap
+import os
+import multiprocessing
+import signal
+import sys
 
 # Consts
 hostName = "127.0.0.1"
 serverPort = 8123
 
 SLEEP = 0.1
+
+# Idle seconds before a persistent connection (--keep-alive) is closed
+KEEP_ALIVE_TIMEOUT = 15
 MAX_GENERATIONS = 6
 
 DATA_FOLDER = 'data/'
 
+# Most records a /records or /stream request can ask for, a whole city
+MAX_RANGE = 10000
+
+# Reply to /record/{city}/{recno}, the same text json.dumps() makes for the dict
+RECORD_JSON = '{"status": "OK", "city": "%s", "date": "%s", "temp": %s}'
+
 # Global Variables
 max_thread_count = 0
 call_count = 0
@@ -68,36 +93,488 @@ CITIES = (
     ('phoenix' , 'phoenix.dat'),
 )
 
-# key = 'city name', value [[date, temp], ...]
+# key = 'city name', value CityData
 cities_data = {}
 
 start_time = time.time()
 end_time = time.time()
 
 # ----------------------------------------------------------------------------
+# Log levels, each one includes the levels before it
+LOG_SUMMARY = 0      # /start and /end details only
+LOG_REQUESTS = 1     # plus one line per request
+LOG_PAYLOADS = 2     # plus the JSON sent for every request
+LOG_LEVELS = {'summary': LOG_SUMMARY, 'requests': LOG_REQUESTS, 'payloads': LOG_PAYLOADS}
+
+LOG_BUFFER_SIZE = 100000     # max lines held in memory, the oldest are dropped
+LOG_FLUSH_INTERVAL = 0.5     # seconds between writes to the file
+LOG_FLUSH_SIZE = 5000        # write sooner once this many lines are waiting
+
 class Log:
+    """ Server log written to the file by a background thread
 
-    def __init__(self, filename):
+    write() only appends the line to a bounded in-memory buffer, so request
+    handlers never wait on the disk.  The writer thread saves the buffer
+    every flush_interval seconds, or sooner when flush_size lines are waiting.
+    With no filename nothing is written and there is no writer thread.
+    With start=False lines are only kept until start() starts the writer.
+    """
+
+    def __init__(self, filename, level=LOG_PAYLOADS, start=True):
         super().__init__()
-        self.lock = threading.Lock()
         self.filename = filename
+        self.level = level
+        self.flush_interval = LOG_FLUSH_INTERVAL
+        self.flush_size = LOG_FLUSH_SIZE
+        self.lines = collections.deque(maxlen=LOG_BUFFER_SIZE)
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.file = None
+        self.writer = None
+        if filename == None:
+            self.level = -1
+            return
         self.file = open(filename, 'w')
+        if start:
+            self.start()
+
+    def start(self):
+        self.writer = threading.Thread(target=self._writer, daemon=True)
+        self.writer.start()
+
+    def write(self, line, level=LOG_SUMMARY):
+        if level > self.level:
+            return
+        with self.condition:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped += 1
+            self.lines.append(line)
+            if len(self.lines) >= self.flush_size:
+                self.condition.notify()
+
+    def _writer(self):
+        closed = False
+        while not closed:
+            with self.condition:
+                if not self.closed and len(self.lines) < self.flush_size:
+                    self.condition.wait(self.flush_interval)
+                lines = list(self.lines)
+                self.lines.clear()
+                dropped = self.dropped
+                self.dropped = 0
+                closed = self.closed
+
+            if dropped > 0:
+                self.file.write(f'*** {dropped} log lines were dropped ***\n')
+            if lines:
+                self.file.write('\n'.join(lines))
+                self.file.write('\n')
+                self.file.flush()
+
+        self.file.close()
+
+    def close(self):
+        if self.writer == None:
+            return
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        self.writer.join()
+
+# Global log object, server.log is only opened by __main__ so importing
+# this module (the benchmarks) doesn't empty the log of a running server
+log = Log(None)
+# close whichever log is current at exit, __main__ replaces this one
+atexit.register(lambda: log.close())
+
+# ----------------------------------------------------------------------------
+def percentile(times, pct):
+    if not times:
+        return 0.0
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * pct / 100))]
+
+# Upper bounds of the /stats latency histogram buckets, the last bucket is everything slower
+HISTOGRAM_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
 
-    def write(self, line):
+class Stats:
+    """ Handler times (seconds) of the requests since /start """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
         with self.lock:
-            self.file.write(line)
-            self.file.write('\n')
-            self.file.flush()
+            self.origin = time.perf_counter()
+            self.times = []
+            self.window = []     # times since the last quiet mode report
+            self.starts = []     # perf_counter() when each request started
+            self.paths = []
+
+    def add(self, started, finished, path):
+        seconds = finished - started
+        with self.lock:
+            self.times.append(seconds)
+            self.window.append(seconds)
+            self.starts.append(started)
+            self.paths.append(path)
+
+    def take_window(self):
+        with self.lock:
+            window = self.window
+            self.window = []
+        return window
+
+    def percentiles(self):
+        with self.lock:
+            times = list(self.times)
+        return percentile(times, 50), percentile(times, 99)
+
+    def export(self):
+        """ Returns the /stats data: every request, a latency histogram and the
+            number of requests being handled over time, times are seconds since /start """
+        with self.lock:
+            origin = self.origin
+            times = list(self.times)
+            starts = list(self.starts)
+            paths = list(self.paths)
+
+        timeline = []
+        counts = [0] * (len(HISTOGRAM_MS) + 1)
+        events = []
+        for seconds, started, path in zip(times, starts, paths):
+            start = started - origin
+            timeline.append([round(start, 6), round(start + seconds, 6), path])
+            counts[bisect.bisect_left(HISTOGRAM_MS, seconds * 1000)] += 1
+            events.append((start, 1))
+            events.append((start + seconds, -1))
+
+        # [time, requests in progress] every time the number changes
+        concurrency = []
+        active = 0
+        for when, change in sorted(events):
+            active += change
+            if concurrency and concurrency[-1][0] == round(when, 6):
+                concurrency[-1][1] = active
+            else:
+                concurrency.append([round(when, 6), active])
+
+        return {
+            'requests': len(timeline),
+            'timeline': timeline,
+            'histogram': {'upper_ms': list(HISTOGRAM_MS) + [None], 'counts': counts},
+            'concurrency': concurrency,
+        }
+
+# Global stats object
+stats = Stats()
+
+# Quiet mode replaces the per-request printing with a stats line every STATS_INTERVAL seconds
+quiet = False
+STATS_INTERVAL = 1.0
+
+def report_stats():
+    last_count = call_count
+    last_time = time.time()
+    while True:
+        time.sleep(STATS_INTERVAL)
+        now = time.time()
+        with lock:
+            count = call_count
+            active = thread_count
+            max_active = max_thread_count
+
+        window = stats.take_window()
+        if window or active > 0:
+            # call_count is reset by /start
+            rate = max(0, count - last_count) / (now - last_time)
+            print(f'Requests/sec: {rate:8.1f} | in-flight: {active:5} | max in-flight: {max_active:5} | '
+                  f'p50: {percentile(window, 50) * 1000:7.1f} ms | p99: {percentile(window, 99) * 1000:7.1f} ms')
+        last_count = count
+        last_time = now
+
+
+# ----------------------------------------------------------------------------
+# Handler times above this many ms share the last bucket of SharedCounters.histogram
+SHARED_HISTOGRAM_MS = 10000
+
+class SharedCounters:
+    """ Request counts of all the --workers processes, created before forking
+
+    The values live in shared memory (multiprocessing.RawArray) so every
+    worker adds to the same totals. Percentiles come from a histogram with
+    1 ms buckets, because the handler times themselves stay in each worker.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = multiprocessing.Lock()
+        self.counts = multiprocessing.RawArray('q', 3)      # calls, active, max active
+        self.start_time = multiprocessing.RawValue('d', time.time())
+        self.histogram = multiprocessing.RawArray('q', SHARED_HISTOGRAM_MS + 1)
+
+    def reset(self):
+        with self.lock:
+            # /start is still active
+            self.counts[0] = 1
+            self.counts[1] = 1
+            self.counts[2] = 1
+            self.start_time.value = time.time()
+            for i in range(len(self.histogram)):
+                self.histogram[i] = 0
+
+    def started(self):
+        with self.lock:
+            self.counts[0] += 1
+            self.counts[1] += 1
+            if self.counts[1] > self.counts[2]:
+                self.counts[2] = self.counts[1]
+
+    def finished(self, seconds):
+        with self.lock:
+            self.counts[1] -= 1
+            self.histogram[min(int(seconds * 1000), SHARED_HISTOGRAM_MS)] += 1
+
+    def totals(self):
+        """ Returns (calls, active, max active, start time) """
+        with self.lock:
+            return self.counts[0], self.counts[1], self.counts[2], self.start_time.value
+
+    def percentiles(self):
+        """ p50 and p99 in seconds, to the nearest ms """
+        with self.lock:
+            histogram = list(self.histogram)
+
+        total = sum(histogram)
+        if total == 0:
+            return 0.0, 0.0
+
+        results = []
+        for pct in (50, 99):
+            wanted = min(total - 1, int(total * pct / 100))
+            seen = 0
+            for ms, count in enumerate(histogram):
+                seen += count
+                if seen > wanted:
+                    results.append(ms / 1000)
+                    break
+        return results[0], results[1]
+
+# SharedCounters of the --workers processes, None when there is one process
+shared = None
+
+def report_shared_stats():
+    """ report_stats() for --workers, run by the parent process """
+    last_count = 0
+    last_time = time.time()
+    while True:
+        time.sleep(STATS_INTERVAL)
+        now = time.time()
+        count, active, max_active, _ = shared.totals()
+        if count != last_count or active > 0:
+            rate = max(0, count - last_count) / (now - last_time)
+            print(f'Requests/sec: {rate:8.1f} | in-flight: {active:5} | max in-flight: {max_active:5}')
+        last_count = count
+        last_time = now
+
+
+# ----------------------------------------------------------------------------
+# The same in every course server (Star Wars, weather, Family Search). Each lesson
+# folder runs on its own, so this is copied instead of imported: change every copy.
+LATENCY_KINDS = ('fixed', 'uniform', 'lognormal')
+
+class LatencyModel:
+    """ How long each request sleeps and how often it fails (--latency options)
+
+    A path starts from the latency of its longest matching prefix in
+    endpoints, or base when none match, then
+        fixed     : always that latency
+        uniform   : anywhere within +/- spread (a fraction) of it
+        lognormal : a long tail with that latency as the median, spread is sigma
+    outlier_rate of the requests sleep another outlier_delay seconds.
+    """
+
+    def __init__(self, base, endpoints=None, kind='fixed', spread=0.5, outlier_rate=0.0, outlier_delay=0.0,
+                 error_rate=0.0, empty_rate=0.0, seed=None):
+        super().__init__()
+        self.base = base
+        self.endpoints = dict(endpoints or {})
+        self.kind = kind
+        self.spread = spread
+        self.outlier_rate = outlier_rate
+        self.outlier_delay = outlier_delay
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def median(self, path):
+        best = None
+        for prefix in self.endpoints:
+            if path.startswith(prefix) and (best == None or len(prefix) > len(best)):
+                best = prefix
+        return self.base if best == None else self.endpoints[best]
+
+    def delay(self, path):
+        """ Seconds to sleep before answering path """
+        median = self.median(path)
+        with self.lock:
+            if self.kind == 'uniform':
+                seconds = self.rand.uniform(median * (1 - self.spread), median * (1 + self.spread))
+            elif self.kind == 'lognormal' and median > 0:
+                seconds = self.rand.lognormvariate(math.log(median), self.spread)
+            else:
+                seconds = median
+
+            if self.outlier_rate > 0 and self.rand.random() < self.outlier_rate:
+                seconds += self.outlier_delay
+
+        return max(seconds, 0.0)
+
+    def fault(self):
+        """ Returns 'error' (reply 500), 'empty' (reply null) or None for a normal reply """
+        if self.error_rate <= 0 and self.empty_rate <= 0:
+            return None
+
+        with self.lock:
+            roll = self.rand.random()
+        if roll < self.error_rate:
+            return 'error'
+        if roll < self.error_rate + self.empty_rate:
+            return 'empty'
+        return None
+
+
+def add_latency_arguments(parser, delay):
+    parser.add_argument('--delay', type=float, default=delay,
+                        help='median latency in seconds of each request')
+    parser.add_argument('--latency', choices=LATENCY_KINDS, default='fixed',
+                        help='how the latency of each request varies around its median')
+    parser.add_argument('--latency-spread', type=float, default=0.5,
+                        help='uniform: +/- this fraction of the median, lognormal: sigma')
+    parser.add_argument('--latency-endpoint', action='append', default=[], metavar='PREFIX=SECONDS',
+                        help='median latency of the paths starting with PREFIX, can be repeated')
+    parser.add_argument('--outlier-rate', type=float, default=0.0,
+                        help='fraction of requests that are slow outliers')
+    parser.add_argument('--outlier-delay', type=float, default=0.0,
+                        help='extra seconds an outlier sleeps')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of data requests answered with a 500 error')
+    parser.add_argument('--empty-rate', type=float, default=0.0,
+                        help='fraction of data requests answered with an empty (null) body')
+    parser.add_argument('--latency-seed', type=int,
+                        help='seed for the latencies and failures, so runs can be repeated')
+
+
+def latency_from_args(args, base, endpoints=None):
+    """ The LatencyModel for the --latency options, --latency-endpoint overrides endpoints """
+    endpoints = dict(endpoints or {})
+    for item in args.latency_endpoint:
+        prefix, _, seconds = item.partition('=')
+        endpoints[prefix] = float(seconds)
+
+    return LatencyModel(base, endpoints, args.latency, args.latency_spread, args.outlier_rate, args.outlier_delay,
+                        args.error_rate, args.empty_rate, args.latency_seed)
+
+# Only /record, /records and each /stream page sleep unless --latency-endpoint says otherwise
+latency = LatencyModel(0.0, {'/record/': SLEEP, '/records/': SLEEP, '/stream/': SLEEP})
+
+
+# ----------------------------------------------------------------------------
+def convert_city(dat_filename, bin_filename):
+    """ Write the records of a DAT file to a binary file: every date as a
+        uint32 mmddhhmmss, then every temp as a float32 (native byte order) """
+    with open(dat_filename, 'r') as f:
+        records = json.load(f)
+
+    # "mmdd hhmmss" -> mmddhhmmss
+    dates = array('I', (int(date_str[:4] + date_str[5:]) for date_str, _ in records))
+    temps = array('f', (temp for _, temp in records))
+
+    # Write a temporary file and rename it, so an interrupted conversion never leaves a short .bin file
+    tmp_filename = bin_filename + '.tmp'
+    try:
+        with open(tmp_filename, 'wb') as f:
+            dates.tofile(f)
+            temps.tofile(f)
+        os.replace(tmp_filename, bin_filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def bin_is_current(dat_filename, bin_filename):
+    """ True when the binary file is newer than the DAT file and holds whole records """
+    if not os.path.exists(bin_filename) or os.path.getmtime(bin_filename) < os.path.getmtime(dat_filename):
+        return False
+    size = os.path.getsize(bin_filename)
+    return size > 0 and size % 8 == 0
+
+
+class CityData:
+    """ The records of one city, memory-mapped from the file made by convert_city() """
+
+    def __init__(self, filename):
+        super().__init__()
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        count = len(self.map) // 8
+        view = memoryview(self.map)
+        self.dates = view[:count * 4].cast('I')
+        self.temps = view[count * 4:count * 8].cast('f')
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, recno):
+        """ Returns ("mm-dd hh:mm:ss", temp), temp is an int when it is a whole number """
+        date = self.dates[recno]
+        temp = self.temps[recno]
+        if temp.is_integer():
+            temp = int(temp)
+        return f'{date // 100000000:02}-{date // 1000000 % 100:02} {date // 10000 % 100:02}:{date // 100 % 100:02}:{date % 100:02}', temp
+
+
+def load_cities():
+    """ Map the binary city files, converting a DAT file the first time or when it changes """
+    global cities_data
+
+    cities_data = {}
+    for name, filename in CITIES:
+        dat_filename = DATA_FOLDER + filename
+        bin_filename = os.path.splitext(dat_filename)[0] + '.bin'
+        if not bin_is_current(dat_filename, bin_filename):
+            print(s := f'Converting city data {name} to {bin_filename}')
+            log.write(s)
+            convert_city(dat_filename, bin_filename)
+
+        print(s := f'Loading city data {name}')
+        log.write(s)
+        cities_data[name] = CityData(bin_filename)
+
+
+def get_records(name, start, count):
+    """ Returns [[date, temp], ...] for records start to start + count - 1 of a city """
+    city = cities_data[name]
+    return [list(city[recno]) for recno in range(start, min(start + count, len(city)))]
 
-    def __del__(self):
-        self.file.close()
 
-# Global log object
-log = Log('server.log')
+def valid_range(name, start, count):
+    """ True when a /records or /stream request asks for a known city and a sensible range """
+    return name in cities_data and start >= 0 and 1 <= count <= MAX_RANGE
+
 
 # ----------------------------------------------------------------------------
 class Handler(BaseHTTPRequestHandler):
 
+    # HTTP/1.0 closes the connection after each reply, --keep-alive switches to HTTP/1.1
+    protocol_version = 'HTTP/1.0'
+
     def get_city_details(self, name):
         # global people
         # if id in people:
@@ -115,7 +592,12 @@ class Handler(BaseHTTPRequestHandler):
         #     return None
         pass
 
-   
+
+    def log_message(self, format, *args):
+        # BaseHTTPRequestHandler prints every request to stderr
+        if not quiet:
+            super().log_message(format, *args)
+
     def do_GET(self):
         global thread_count
         global lock
@@ -123,190 +605,385 @@ class Handler(BaseHTTPRequestHandler):
         global call_count
         global log
 
+        if self.path == '/stats':
+            self.send_json(json.dumps(stats.export()))
+            return
+
         with lock:
             thread_count += 1
             call_count += 1
             if thread_count > max_thread_count:
                 max_thread_count = thread_count
-            print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
-            log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
+            if not quiet:
+                print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
+            log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}', LOG_REQUESTS)
+
+        if shared != None:
+            shared.started()
+
+        if not quiet:
+            print('- ' * 35)
+            print(f'Request: {self.path}')
+        log.write(f'Request: {self.path}', LOG_REQUESTS)
+
+        started = time.perf_counter()
+        try:
+            self.send_reply()
+        finally:
+            finished = time.perf_counter()
+            stats.add(started, finished, self.path)
+            if shared != None:
+                shared.finished(finished - started)
+            with lock:
+                thread_count -= 1
+
+    def send_reply(self):
+        # /stream sleeps once per page instead
+        if not self.path.startswith('/stream/'):
+            delay = latency.delay(self.path)
+            if delay > 0:
+                time.sleep(delay)
+
+        # Only the data requests fail, never /start or /end
+        if self.path.startswith(('/city/', '/record/', '/records/', '/stream/')):
+            fault = latency.fault()
+            if fault == 'error':
+                self.send_error(500)
+                return
+            if fault == 'empty':
+                self.send_json('null')
+                return
 
-        print('- ' * 35)
-        print(s := f'Request: {self.path}')
-        log.write(s)
+        route = router.match(self.path)
+        json_data = None
+        if route != None:
+            handler, args = route
+            json_data = handler(self, *args)
 
-        # START ---------------------------------------------------
-        if 'start' in self.path:
-            global start_time
-            global cities_data
+        # /stream returns the pages to send
+        if json_data != None and not isinstance(json_data, str):
+            self.send_stream(json_data)
+            return
 
-            # Load DAT files
-            cities_data = {}
-            for name, filename in CITIES:
-                print(s := f'Loading city data {name}')
-                log.write(s)
-                with open(DATA_FOLDER + filename, 'r') as f:
-                    cities_data[name] = json.load(f)
+        if json_data != None:
+            if not quiet:
+                print('Sending:', json_data)
+            log.write(f'Sending: {json_data}', LOG_PAYLOADS)
 
-            max_thread_count = 1
-            thread_count = 1
-            call_count = 1
+        self.send_json(json_data)
 
-            start_time = time.time()
+    # START ---------------------------------------------------
+    def reply_start(self):
+        global thread_count
+        global max_thread_count
+        global call_count
+        global start_time
 
-            json_data = '{"status":"OK"}'
+        # The city files are only mapped once, with --workers before the workers started
+        if not cities_data:
+            load_cities()
 
+        max_thread_count = 1
+        thread_count = 1
+        call_count = 1
 
-        # END ---------------------------------------------------
-        elif 'end' in self.path:
-            global end_time
+        stats.reset()
+        if shared != None:
+            shared.reset()
+        start_time = time.time()
 
-            end_time = time.time()
+        return '{"status":"OK"}'
 
-            print('#' * 80)
-            log.write('#' * 80)
+    # END ---------------------------------------------------
+    def reply_end(self):
+        global end_time
 
-            print(s := f'Total number of API calls     : {call_count}')
-            log.write(s)
+        end_time = time.time()
 
-            print(s := f'Final thread count (max count): {max_thread_count}')
-            log.write(s)
+        # with --workers the totals of every worker, not just this one
+        calls, max_count, began = call_count, max_thread_count, start_time
+        if shared != None:
+            calls, _, max_count, began = shared.totals()
 
-            print(s := f'Total time (seconds)          : {end_time - start_time}')
-            log.write(s)
+        print('#' * 80)
+        log.write('#' * 80)
 
-            print(s := f'Calls per second              : {call_count / (end_time - start_time)}')
-            log.write(s)
+        print(s := f'Total number of API calls     : {calls}')
+        log.write(s)
 
-            data_str = '{' + \
-                       f'"status":"OK", "api": {call_count}, "threads": {max_thread_count}, "total_time": {end_time - start_time}, "calls_per_second": {call_count / (end_time - start_time)}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
-
-            print('#' * 80)
-            log.write('#' * 80)
-
-        # CITY DETAILS  ---------------------------------------------------
-        elif 'city' in self.path:
-            parts = self.path.split('/')
-            # print('****************************')
-            # print(parts)
-
-            if len(parts) != 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+        print(s := f'Final thread count (max count): {max_count}')
+        log.write(s)
 
-            try:
-                name = parts[-1].lower()
-            except:
-                name = None
-
-            if name == None:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+        print(s := f'Total time (seconds)          : {end_time - began}')
+        log.write(s)
 
-            if name not in cities_data:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+        print(s := f'Calls per second              : {calls / (end_time - began)}')
+        log.write(s)
 
-            data_str = '{' + \
-                       f'"status":"OK", "city": "{name}", "records": {len(cities_data[name])}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
+        p50, p99 = stats.percentiles() if shared == None else shared.percentiles()
+        print(s := f'Handler time p50 / p99 (ms)   : {p50 * 1000:.1f} / {p99 * 1000:.1f}')
+        log.write(s)
 
-        # CITY RECORD  ---------------------------------------------------
-        elif 'record' in self.path:
+        json_data = json.dumps({'status': 'OK', 'api': calls, 'threads': max_count, 'total_time': end_time - began,
+                                'calls_per_second': calls / (end_time - began), 'p50': p50, 'p99': p99})
 
-            if SLEEP > 0:
-                time.sleep(SLEEP)
+        print('#' * 80)
+        log.write('#' * 80)
 
-            parts = self.path.split('/')
-            # print('****************************')
-            # print(parts)
+        return json_data
 
-            if len(parts) != 4:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+    # CITY DETAILS  ---------------------------------------------------
+    def reply_city(self, name):
+        name = name.lower()
+        if name not in cities_data:
+            return None
 
-            try:
-                name = parts[-2].lower()
-                record = int(parts[-1])
-            except:
-                name = None
-                record = None
-
-            if name == None or record == None:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+        return json.dumps({'status': 'OK', 'city': name, 'records': len(cities_data[name])})
 
-            if name not in cities_data:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+    # CITY RECORD  ---------------------------------------------------
+    def reply_record(self, name, recno):
+        name = name.lower()
+        if name not in cities_data or not 0 <= recno < len(cities_data[name]):
+            return None
 
-            date_str = cities_data[name][record][0]         # Format "mmdd hhmmss"
-            temp = cities_data[name][record][1]
+        date_str, temp = cities_data[name][recno]       # Format "mm-dd hh:mm:ss"
 
-            # Expand date string to "mm-dd hh:mm:ss"
-            #         01234567890
-            # format "mmdd hhmmss"
-            date_str = date_str[:2] + '-' + date_str[2:4] + ' ' + date_str[5:7] + ':' + date_str[7:9] + ':' + date_str[9:]
+        # name is one of the cities and date_str only has digits, so nothing needs escaping
+        return RECORD_JSON % (name, date_str, temp)
 
-            data_str = '{' + \
-                       f'"status":"OK", "city": "{name}", "date": "{date_str}", "temp": {temp}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
+    # RECORD RANGES ---------------------------------------------------
+    def reply_records(self, name, start, count):
+        name = name.lower()
+        if not valid_range(name, start, count):
+            return None
 
-        else:
-            json_data = None
+        records = get_records(name, start, count)
+        return json.dumps({'status': 'OK', 'city': name, 'start': start, 'count': len(records), 'records': records})
+
+    def reply_stream(self, name, start, count, page):
+        name = name.lower()
+        if not valid_range(name, start, count) or page < 1:
+            return None
+
+        return self.stream_pages(name, start, count, page)
 
+    def stream_pages(self, name, start, count, page):
+        """ Yields one JSON line per page, sleeping once before each page """
+        end = min(start + count, len(cities_data[name]))
+        for page_start in range(start, end, page):
+            delay = latency.delay(self.path)
+            if delay > 0:
+                time.sleep(delay)
 
+            records = get_records(name, page_start, min(page, end - page_start))
+            yield json.dumps({'status': 'OK', 'city': name, 'start': page_start, 'count': len(records), 'records': records})
+
+        log.write(f'Sent records {start} to {end - 1} of {name} in pages of {page}', LOG_PAYLOADS)
+
+    def send_stream(self, pages):
+        """ Send each JSON page as a line as soon as it is ready.
+            HTTP/1.1 (--keep-alive) uses chunks, HTTP/1.0 ends the reply by closing """
+        chunked = self.protocol_version == 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header("Content-type",  "application/x-ndjson")
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        for page in pages:
+            line = bytes(page + '\n', 'utf8')
+            if chunked:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+            else:
+                self.wfile.write(line)
+
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def send_json(self, json_data):
+        """ Send the JSON string, or a 404 when json_data is None """
         if json_data == None:
             self.send_response(404)
             self.send_header("Content-type",  "application/json")
+            self.send_header("Content-Length", "0")
             self.end_headers()
         else:
-            print('Sending:', json_data)
-            log.write(f'Sending: {json_data}')
-
+            body = bytes(json_data, "utf8")
             self.send_response(200)
             self.send_header("Content-type",  "application/json")
+            self.send_header("Content-Length", str(len(body)))
             self.end_headers()
-            self.wfile.write(bytes(json_data, "utf8"))
-
-        with lock:
-            thread_count -= 1
+            self.wfile.write(body)
 
 
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
     pass
 
 
-if __name__ == '__main__':
+# ----------------------------------------------------------------------------
+# The same in every course server (Star Wars, weather, Family Search). Each lesson
+# folder runs on its own, so this is copied instead of imported: change every copy.
+class Router:
+    """ Table of path templates such as '/record/{city}/{recno:int}' to handlers
+
+    Only the first segment of a template is fixed, the rest are {fields}.
+    A path is looked up by its first segment and number of segments (one
+    dict access), then the :int fields are converted and the fields are
+    passed to the handler in order. A path that matches no template, or has
+    a bad :int field, has no route, so the server only needs one 404 path.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.routes = {}
+
+    def add(self, template, handler):
+        parts = template.strip('/').split('/')
+        int_fields = []
+        for index, part in enumerate(parts[1:]):
+            if not (part.startswith('{') and part.endswith('}')):
+                raise ValueError(f'Only the first segment of {template} can be fixed')
+            if part.endswith(':int}'):
+                int_fields.append(index)
+        self.routes[(parts[0], len(parts))] = (handler, tuple(int_fields))
+
+    def match(self, path):
+        """ Returns (handler, [field values]), None when no template matches """
+        if '?' in path:
+            path = path[:path.index('?')]
+        parts = path.strip('/').split('/')
+        route = self.routes.get((parts[0], len(parts)))
+        if route == None:
+            return None
+
+        handler, int_fields = route
+        args = parts[1:]
+        try:
+            for index in int_fields:
+                args[index] = int(args[index])
+        except ValueError:
+            return None
+        return handler, args
+
+
+router = Router()
+router.add('/start', Handler.reply_start)
+router.add('/end', Handler.reply_end)
+router.add('/city/{city}', Handler.reply_city)
+router.add('/record/{city}/{recno:int}', Handler.reply_record)
+router.add('/records/{city}/{start:int}/{count:int}', Handler.reply_records)
+router.add('/stream/{city}/{start:int}/{count:int}/{page:int}', Handler.reply_stream)
+
+
+# ----------------------------------------------------------------------------
+def serve():
+    """ Serve requests until <Ctrl-C> """
     server = ThreadingSimpleServer((hostName, serverPort), Handler)
-    print(f'Starting server.  Waiting on {hostName}:{serverPort}, use <Ctrl-C> or <Command-C> to stop')
-    server.serve_forever()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(count):
+    """ Fork count processes that all listen on serverPort (SO_REUSEPORT), the
+        kernel spreads the connections over them. Waits for them to stop. """
+    global log
+
+    pids = []
+    for number in range(1, count + 1):
+        pid = os.fork()
+        if pid == 0:
+            # Every worker writes its own log
+            level, flush_interval, flush_size = log.level, log.flush_interval, log.flush_size
+            log = Log(f'server-{number}.log', level)
+            log.flush_interval = flush_interval
+            log.flush_size = flush_size
+            # SIGTERM from the parent stops the worker like <Ctrl-C>, so its log is closed
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            try:
+                serve()
+            finally:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                log.close()
+                os._exit(0)
+        pids.append(pid)
+
+    # Forking a process that has threads can deadlock, so the parent's threads start now
+    log.start()
+    if quiet:
+        threading.Thread(target=report_shared_stats, daemon=True).start()
+
+    # SIGTERM is handled like <Ctrl-C>: every worker is told to stop, then waited for
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        # The signal may only have reached this process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Weather server')
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='payloads',
+                        help='how much of each request is written to server.log')
+    parser.add_argument('--log-flush-interval', type=float, default=LOG_FLUSH_INTERVAL,
+                        help='seconds between writes of server.log')
+    parser.add_argument('--log-flush-size', type=int, default=LOG_FLUSH_SIZE,
+                        help='write server.log early once this many lines are waiting')
+    parser.add_argument('--quiet', action='store_true',
+                        help='no printing per request, print a stats line every --stats-interval seconds')
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help='seconds between stats lines in quiet mode')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='use HTTP/1.1 persistent connections so clients can reuse sockets')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes serving the port, with more than 1 the city data is '
+                             'loaded once at startup and /start only resets the counts')
+    add_latency_arguments(parser, SLEEP)
+    args = parser.parse_args()
+
+    # --delay is the latency of /record, /records and each /stream page, the other requests don't sleep
+    latency = latency_from_args(args, 0.0, {'/record/': args.delay, '/records/': args.delay, '/stream/': args.delay})
+
+    # With --workers the writer thread is only started once the workers are forked
+    log = Log('server.log', LOG_LEVELS[args.log_level], start=args.workers <= 1)
+    log.flush_interval = args.log_flush_interval
+    log.flush_size = args.log_flush_size
+    quiet = args.quiet
+    STATS_INTERVAL = args.stats_interval
+
+    if args.keep_alive:
+        Handler.protocol_version = 'HTTP/1.1'
+        Handler.timeout = KEEP_ALIVE_TIMEOUT
+        # the headers and body go out in separate writes, without TCP_NODELAY the
+        # body waits for the delayed ACK of the headers (~40 ms) on a reused connection
+        Handler.disable_nagle_algorithm = True
+        # don't wait for idle connections when the server is stopped
+        ThreadingSimpleServer.daemon_threads = True
+
+    if args.workers > 1:
+        shared = SharedCounters()
+        ThreadingSimpleServer.allow_reuse_port = True
+        load_cities()
+        print(f'Starting server ({args.workers} workers).  Waiting on {hostName}:{serverPort}, use <Ctrl-C> or <Command-C> to stop')
+        run_workers(args.workers)
+    else:
+        if quiet:
+            threading.Thread(target=report_stats, daemon=True).start()
+        print(f'Starting server.  Waiting on {hostName}:{serverPort}, use <Ctrl-C> or <Command-C> to stop')
+        serve()
 
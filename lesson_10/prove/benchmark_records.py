@@ -0,0 +1,99 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: benchmark_records.py
+Purpose: Compare Person/Family with CompactPerson/CompactFamily
+
+Builds a family tree with the server's own code (no HTTP), or reads one
+recorded with server.py --record, turns every record into the same dict the
+client gets from get_data_from_server(), then times how long it takes to
+build a Tree from those dicts with each pair of classes and how much memory
+the records use.
+
+    python benchmark_records.py --generations 10
+    python benchmark_records.py --dump tree.json
+"""
+
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from common import Tree, Person, Family, CompactPerson, CompactFamily
+import server
+
+
+# ----------------------------------------------------------------------------
+def load_records(generations):
+    """ Returns (start family id, person dicts, family dicts) for a new tree """
+    server.build_tree(generations)
+    server.cache_records()
+    people = [json.loads(data) for data in server.person_json.values()]
+    families = [json.loads(data) for data in server.family_json.values()]
+    return families[0]['id'], people, families
+
+
+def load_dump(filename):
+    """ Same as load_records() for a tree written by server.py --record """
+    with open(filename) as f:
+        tree = json.load(f)
+    return tree['start_family_id'], tree['people'], tree['families']
+
+
+def build(start_id, people, families, person_class, family_class):
+    tree = Tree(start_id)
+    for data in families:
+        tree.add_family(family_class(data))
+    for data in people:
+        tree.add_person(person_class(data))
+    return tree
+
+
+def time_build(start_id, people, families, person_class, family_class, repeat):
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        begin = time.perf_counter()
+        build(start_id, people, families, person_class, family_class)
+        total = time.perf_counter() - begin
+        if best is None or total < best:
+            best = total
+    return best
+
+
+def record_memory(people, families, person_class, family_class):
+    """ Bytes allocated by the record objects alone, the Tree dicts aren't counted """
+    gc.collect()
+    tracemalloc.start()
+    records = [person_class(data) for data in people]
+    records += [family_class(data) for data in families]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Person/Family vs CompactPerson/CompactFamily')
+    parser.add_argument('--generations', type=int, default=10)
+    parser.add_argument('--dump', metavar='FILE', help='use a tree written by server.py --record')
+    parser.add_argument('--repeat', type=int, default=5, help='best of this many builds is reported')
+    args = parser.parse_args()
+
+    if args.dump:
+        start_id, people, families = load_dump(args.dump)
+    else:
+        start_id, people, families = load_records(args.generations)
+    count = len(people) + len(families)
+
+    print(f'{"classes":<30} {"build (s)":>10} {"memory (MB)":>12} {"bytes/record":>13}')
+    for title, person_class, family_class in (('Person / Family', Person, Family),
+                                              ('CompactPerson / CompactFamily', CompactPerson, CompactFamily)):
+        total = time_build(start_id, people, families, person_class, family_class, args.repeat)
+        size = record_memory(people, families, person_class, family_class)
+        print(f'{title:<30} {total:>10.4f} {size / 1_000_000:>12.2f} {size / count:>13.1f}')
+
+
+if __name__ == '__main__':
+    main()
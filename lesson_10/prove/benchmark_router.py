@@ -0,0 +1,219 @@
+"""
+Course: CSE 351
+Lesson Week: 10
+File: benchmark_router.py
+Purpose: Time how the Family Search server picks the handler for a path
+
+Compares the old if/elif chain of create_response() ('start' in path, then
+'end' in path, ...) with the Router table that server.py uses now. Only the
+dispatch is timed: finding the handler and parsing its arguments, not
+building the reply. Both must pick the same handler for every path.
+
+The paths are matched by one thread, then by --threads threads at the same
+time. Then each dispatch serves a real tree from a server process on
+--port with no latency, and --clients threads send --requests requests
+each over keep-alive connections, to see what the dispatch costs under load.
+
+    python benchmark_router.py --calls 200000 --threads 32 --clients 32 --requests 2000
+"""
+
+import argparse
+import http.client
+import multiprocessing
+import socket
+import threading
+import time
+
+import server
+
+
+PATHS = (
+    '/',
+    '/start/6',
+    '/start/6/101',
+    '/family/3462189',
+    '/person/1834456',
+    '/person/2299871',
+    '/families/3462189,3890104,2210983,1117721',
+    '/people/1834456,2299871,1011201,4002013,3001118,2891273',
+    '/family/bad',
+    '/unknown/path',
+    '/end',
+)
+
+
+# ----------------------------------------------------------------------------
+def dispatch_old(path):
+    """ The branches of the old create_response(), returns (handler name, args) or None """
+    if 'start' in path:
+        parts = path.split('/')
+        if len(parts) < 3:
+            return None
+        try:
+            generations = int(parts[2])
+        except:
+            generations = server.MAX_GENERATIONS
+        tree_seed = server.seed
+        if len(parts) > 3:
+            try:
+                tree_seed = int(parts[3])
+            except:
+                return None
+        return 'reply_start', [generations, tree_seed]
+
+    elif 'end' in path:
+        return 'reply_end', []
+
+    elif server.is_batch(path):
+        ids = path.split('/')[-1]
+        if path.startswith('/people/'):
+            return 'reply_people', [ids]
+        return 'reply_families', [ids]
+
+    elif 'person' in path or 'family' in path:
+        parts = path.split('/')
+        if len(parts) < 3:
+            return None
+        try:
+            code = int(parts[-1])
+        except:
+            return None
+        if 'person' in path:
+            return 'reply_person', [code]
+        return 'reply_family', [code]
+
+    return 'reply_root', []
+
+
+def dispatch_new(path):
+    """ Same as dispatch_old() with the handler's name, only used to compare the two """
+    route = server.router.match(path)
+    if route == None:
+        return None
+    handler, args = route
+    return handler.__name__, args
+
+
+class OldRouter:
+    """ router.match() done by dispatch_old(), so the server can use either """
+
+    def match(self, path):
+        route = dispatch_old(path)
+        if route == None:
+            return None
+        name, args = route
+        return getattr(server, name), args
+
+
+def run(dispatch, calls):
+    paths = PATHS * (calls // len(PATHS) + 1)
+    for path in paths[:calls]:
+        dispatch(path)
+
+
+def time_threads(dispatch, calls, thread_count):
+    """ Returns the seconds for thread_count threads to do calls dispatches each """
+    threads = [threading.Thread(target=run, args=(dispatch, calls)) for _ in range(thread_count)]
+    begin = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - begin
+
+
+# ----------------------------------------------------------------------------
+def serve_router(router, port):
+    """ Server process: the tree built before the fork, no latency, keep-alive """
+    server.router = router
+    server.serverPort = port
+    server.latency = server.LatencyModel(0.0)
+    server.quiet = True
+    server.Handler.protocol_version = 'HTTP/1.1'
+    server.Handler.disable_nagle_algorithm = True
+    server.ThreadingSimpleServer.daemon_threads = True
+    server.serve(False)
+
+
+def load_paths(generations):
+    """ Builds the tree the server process will serve, returns the paths to ask for """
+    server.create_tree(generations, 101)
+    people = [code for code in server.person_json][:200]
+    families = [code for code in server.family_json][:50]
+    paths = [f'/person/{code}' for code in people] + [f'/family/{code}' for code in families]
+    paths += [f'/people/{",".join(map(str, people[i:i + 10]))}' for i in range(0, len(people), 10)]
+    paths += [f'/families/{",".join(map(str, families[i:i + 5]))}' for i in range(0, len(families), 5)]
+    paths += ['/', '/family/bad', '/unknown/path']
+    return paths
+
+
+def client(port, paths, requests, times):
+    connection = http.client.HTTPConnection(server.hostName, port)
+    for i in range(requests):
+        begin = time.perf_counter()
+        connection.request('GET', paths[i % len(paths)])
+        connection.getresponse().read()
+        times.append(time.perf_counter() - begin)
+    connection.close()
+
+
+def time_server(router, port, paths, client_count, requests):
+    """ Returns (requests/sec, p50, p99) of client_count clients against a server using router """
+    process = multiprocessing.get_context('fork').Process(target=serve_router, args=(router, port), daemon=True)
+    process.start()
+    while True:
+        try:
+            socket.create_connection((server.hostName, port)).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+
+    times = []
+    threads = [threading.Thread(target=client, args=(port, paths, requests, times)) for _ in range(client_count)]
+    begin = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = time.perf_counter() - begin
+
+    process.terminate()
+    process.join()
+    times.sort()
+    return len(times) / total, times[len(times) // 2], times[len(times) * 99 // 100]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='if/elif dispatch vs the Router table')
+    parser.add_argument('--calls', type=int, default=200000, help='dispatches per thread')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--clients', type=int, default=32, help='client threads sending requests to the server')
+    parser.add_argument('--requests', type=int, default=2000, help='requests sent by each client')
+    parser.add_argument('--generations', type=int, default=6, help='size of the tree the server serves')
+    parser.add_argument('--port', type=int, default=8124)
+    args = parser.parse_args()
+
+    print(f'{"path":<60} {"old":<15} {"new":<15}')
+    for path in PATHS:
+        old = dispatch_old(path)
+        new = dispatch_new(path)
+        print(f'{path:<60} {old[0] if old else "404":<15} {new[0] if new else "404":<15}')
+
+    print()
+    print(f'{"dispatch":<10} {"threads":>8} {"us/path":>10} {"paths/sec":>12}')
+    for title, dispatch in (('old', dispatch_old), ('router', server.router.match)):
+        for thread_count in (1, args.threads):
+            total = time_threads(dispatch, args.calls, thread_count)
+            count = args.calls * thread_count
+            print(f'{title:<10} {thread_count:>8} {total / count * 1e6:>10.3f} {count / total:>12,.0f}')
+
+    paths = load_paths(args.generations)
+    print()
+    print(f'{"server":<10} {"clients":>8} {"requests/sec":>13} {"p50 (ms)":>9} {"p99 (ms)":>9}')
+    for title, router in (('old', OldRouter()), ('router', server.router)):
+        rate, p50, p99 = time_server(router, args.port, paths, args.clients, args.requests)
+        print(f'{title:<10} {args.clients:>8} {rate:>13,.0f} {p50 * 1000:>9.2f} {p99 * 1000:>9.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,38 +7,177 @@ Don't change this code.  You are not submitting it with your assignment
 
 """
 import time
+import random
+import threading
 import requests
+import requests.adapters
+import asyncio
+import json
+import urllib.parse
 
 from cse351 import *
 
 TOP_API_URL = 'http://127.0.0.1:8123'
 
+# Connection pool and retry policy used by get_data_from_server()
+# Pooled connections are only reused when the server runs with --keep-alive
+MAX_CONNECTIONS = 256       # connections kept open, use at least the number of worker threads
+RETRIES = 10
+BACKOFF_START = 0.01        # seconds, doubled after every failed attempt
+BACKOFF_MAX = 1.0
+RATE_LIMIT_TIMEOUT = 60.0   # seconds a request keeps retrying 429 (Too Many Requests) replies
+
+_adapter = None
+_adapter_lock = threading.Lock()
+_thread_data = threading.local()
+
+# ----------------------------------------------------------------------------
+def configure_client(max_connections=None, retries=None, backoff_start=None, backoff_max=None,
+                     rate_limit_timeout=None):
+    """ Change the pool size and retry policy, call this before starting any threads """
+    global MAX_CONNECTIONS, RETRIES, BACKOFF_START, BACKOFF_MAX, RATE_LIMIT_TIMEOUT, _adapter
+
+    if max_connections is not None:
+        MAX_CONNECTIONS = max_connections
+    if retries is not None:
+        RETRIES = retries
+    if backoff_start is not None:
+        BACKOFF_START = backoff_start
+    if backoff_max is not None:
+        BACKOFF_MAX = backoff_max
+    if rate_limit_timeout is not None:
+        RATE_LIMIT_TIMEOUT = rate_limit_timeout
+
+    with _adapter_lock:
+        _adapter = None
+
+# ----------------------------------------------------------------------------
+def _get_session():
+    """ Returns this thread's Session, all of the Sessions share one connection pool """
+    global _adapter
+
+    adapter = _adapter
+    if adapter is None:
+        with _adapter_lock:
+            if _adapter is None:
+                _adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONNECTIONS)
+            adapter = _adapter
+
+    if getattr(_thread_data, 'adapter', None) is not adapter:
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _thread_data.session = session
+        _thread_data.adapter = adapter
+
+    return _thread_data.session
+
+# ----------------------------------------------------------------------------
+def _rate_limit_wait(retry_after, delay, give_up_time):
+    """ Seconds to wait before retrying a 429 reply, None once RATE_LIMIT_TIMEOUT has run out.
+        Waits at least the Retry-After seconds, with jitter so the limited requests don't all retry together """
+    try:
+        seconds = max(float(retry_after), delay)
+    except (TypeError, ValueError):
+        seconds = delay
+    seconds *= random.uniform(1.0, 1.5)
+
+    if time.time() + seconds > give_up_time:
+        print("Max retries reached (too many requests). Failing.")
+        return None
+    return seconds
+
 # ----------------------------------------------------------------------------
 def get_data_from_server(url):
-    retries = 50
-    delay = 0.01 # seconds
-    for i in range(retries):
+    """ 429 replies are retried until RATE_LIMIT_TIMEOUT, connection errors RETRIES times """
+    session = _get_session()
+    delay = BACKOFF_START
+    give_up_time = time.time() + RATE_LIMIT_TIMEOUT
+    i = 0
+    while i < RETRIES:
         try:
-            response = requests.get(url, timeout=10)
+            response = session.get(url, timeout=10)
+            if response.status_code == 429:
+                # the server is limiting requests, wait as long as it asks and try again
+                wait = _rate_limit_wait(response.headers.get('Retry-After'), delay, give_up_time)
+                if wait is None:
+                    break
+                time.sleep(wait)
+                delay = min(delay * 2, BACKOFF_MAX)
+                continue
             response.raise_for_status()
             if response.status_code == 200:
                 return response.json()
             break
 
-        except requests.exceptions.ConnectionError as e:
-            if i < retries - 1:
-                time.sleep(delay)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            i += 1
+            if i < RETRIES:
+                # exponential backoff, with jitter so waiting threads don't all retry together
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, BACKOFF_MAX)
             else:
                 print("Max retries reached. Failing.")
                 
-        except requests.exceptions.Timeout:
-            ...
-            
         except requests.exceptions.RequestException as e:
             break
 
     return None
 
+# ----------------------------------------------------------------------------
+async def get_data_from_server_async(url):
+    """ asyncio version of get_data_from_server() using only the standard library """
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    request = bytes(f'GET {path} HTTP/1.0\r\nHost: {parts.netloc}\r\n\r\n', 'latin-1')
+
+    delay = BACKOFF_START
+    give_up_time = time.time() + RATE_LIMIT_TIMEOUT
+    i = 0
+    while i < RETRIES:
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(parts.hostname, parts.port or 80), 10)
+            try:
+                writer.write(request)
+                await writer.drain()
+                # HTTP/1.0, the server closes the connection after the reply
+                response = await asyncio.wait_for(reader.read(), 10)
+            finally:
+                writer.close()
+
+            head, _, body = response.partition(b'\r\n\r\n')
+            lines = head.decode('latin-1').split('\r\n')
+            status = int(lines[0].split(None, 2)[1])
+            if status == 429:
+                retry_after = None
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    if name.strip().lower() == 'retry-after':
+                        retry_after = value.strip()
+                wait = _rate_limit_wait(retry_after, delay, give_up_time)
+                if wait is None:
+                    break
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, BACKOFF_MAX)
+                continue
+            if status == 200:
+                return json.loads(body)
+            break
+
+        except (OSError, asyncio.TimeoutError) as e:
+            i += 1
+            if i < RETRIES:
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, BACKOFF_MAX)
+            else:
+                print("Max retries reached. Failing.")
+
+        except (ValueError, IndexError) as e:
+            # not a valid HTTP response or JSON body
+            break
+
+    return None
+
 # ----------------------------------------------------------------------------
 class Person:
 
@@ -108,7 +247,86 @@ class Family:
         return self.__children
 
 
+# ----------------------------------------------------------------------------
+class CompactPerson:
+    """ Person with the same getters, the fields live in __slots__ instead of a __dict__ """
+
+    __slots__ = ('_id', '_name', '_parents', '_family', '_birth')
+
+    def __init__(self, data):
+        self._id = data['id']
+        self._name = data['name']
+        self._parents = data['parent_id']
+        self._family = data['family_id']
+        self._birth = data['birth']
+
+    def __str__(self):
+        output  = f'id        : {self._id}\n'
+        output += f'name      : {self._name}\n'
+        output += f'birth     : {self._birth}\n'
+        output += f'parent id : {self._parents}\n'
+        output += f'family id : {self._family}\n'
+        return output
+
+    def get_id(self):
+        return self._id
+
+    def get_name(self):
+        return self._name
+
+    def get_birth(self):
+        return self._birth
+
+    def get_parentid(self):
+        return self._parents
+
+    def get_familyid(self):
+        return self._family
+
+
+# ----------------------------------------------------------------------------
+class CompactFamily:
+    """ Family with the same getters, the fields live in __slots__ instead of a __dict__ """
+
+    __slots__ = ('_id', '_husband', '_wife', '_children')
+
+    def __init__(self, data):
+        self._id = data['id']
+        self._husband = data['husband_id']
+        self._wife = data['wife_id']
+        self._children = data['children']
+
+    def children_count(self):
+        return len(self._children)
+
+    def __str__(self):
+        output  = f'id         : {self._id}\n'
+        output += f'husband    : {self._husband}\n'
+        output += f'wife       : {self._wife}\n'
+        for id in self._children:
+            output += f'  Child    : {id}\n'
+        return output
+
+    def get_id(self):
+        return self._id
+
+    def get_husband(self):
+        return self._husband
+
+    def get_wife(self):
+        return self._wife
+
+    def get_children(self):
+        return self._children
+
+
 # -----------------------------------------------------------------------------
+# Number of lock stripes in a Tree (a power of 2), ids only contend with ids in the same stripe
+TREE_STRIPE_BITS = 6
+TREE_STRIPES = 1 << TREE_STRIPE_BITS
+# Number of lines Tree.display() hands to the log in one write
+DISPLAY_BATCH = 600
+
 class Tree:
 
     def __init__(self, start_family_id):
@@ -116,18 +334,46 @@ class Tree:
         self.__people = {}
         self.__families = {}
         self.__start_family_id = start_family_id
+        self.__locks = [threading.Lock() for _ in range(TREE_STRIPES)]
+        self.__claimed_people = [set() for _ in range(TREE_STRIPES)]
+        self.__claimed_families = [set() for _ in range(TREE_STRIPES)]
+
+    def __stripe(self, id):
+        # The low bits of an encoded id can be the same for every id (an even ID),
+        # so mix all of the bits and use the top ones (Fibonacci hashing)
+        return ((id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> (64 - TREE_STRIPE_BITS)
+
+    def claim_person(self, id):
+        """ Returns True for the first caller only, so exactly one thread fetches each person """
+        stripe = self.__stripe(id)
+        with self.__locks[stripe]:
+            if id in self.__claimed_people[stripe]:
+                return False
+            self.__claimed_people[stripe].add(id)
+            return True
+
+    def claim_family(self, id):
+        """ Returns True for the first caller only, so exactly one thread fetches each family """
+        stripe = self.__stripe(id)
+        with self.__locks[stripe]:
+            if id in self.__claimed_families[stripe]:
+                return False
+            self.__claimed_families[stripe].add(id)
+            return True
 
     def add_person(self, person):
-        if self.does_person_exist(person.get_id()):
-            print(f'ERROR: Person with ID = {person.get_id()} Already exists in the tree')
-        else:
-            self.__people[person.get_id()] = person
+        with self.__locks[self.__stripe(person.get_id())]:
+            if self.does_person_exist(person.get_id()):
+                print(f'ERROR: Person with ID = {person.get_id()} Already exists in the tree')
+            else:
+                self.__people[person.get_id()] = person
 
     def add_family(self, family):
-        if self.does_family_exist(family.get_id()):
-            print(f'ERROR: Family with ID = {family.get_id()} Already exists in the tree')
-        else:
-            self.__families[family.get_id()] = family
+        with self.__locks[self.__stripe(family.get_id())]:
+            if self.does_family_exist(family.get_id()):
+                print(f'ERROR: Family with ID = {family.get_id()} Already exists in the tree')
+            else:
+                self.__families[family.get_id()] = family
 
     def get_person(self, id):
         if id in self.__people:
@@ -156,116 +402,84 @@ class Tree:
     def display(self, log):
         log.write('\n\n')
         log.write(f'{" TREE DISPLAY ":*^40}')
-        for family_id in self.__families:
-            fam = self.__families[family_id]
-
-            log.write(f'Family id: {family_id}')
-
-            # Husband
-            husband = self.get_person(fam.get_husband())
-            if husband == None:
-                log.write(f'  Husband: None')
-            else:
-                log.write(f'  Husband: {husband.get_name()}, {husband.get_birth()}')
-
-            # wife
-            wife = self.get_person(fam.get_wife())
-            if wife == None:
-                log.write(f'  Wife: None')
-            else:
-                log.write(f'  Wife: {wife.get_name()}, {wife.get_birth()}')
-
-            # Parents of Husband
-            if husband == None:
-                log.write(f'  Husband Parents: None')
-            else:
-                parent_fam_id = husband.get_parentid()
-                if parent_fam_id in self.__families:
-                    parent_fam = self.get_family(parent_fam_id)
-                    father = self.get_person(parent_fam.get_husband())
-                    mother = self.get_person(parent_fam.get_wife())
-                    log.write(f'  Husband Parents: {father.get_name()} and {mother.get_name()}')
-                else:
-                    log.write(f'  Husband Parents: None')
-
-            # Parents of Wife
-            if wife == None:
-                log.write(f'  Wife Parents: None')
-            else:
-                parent_fam_id = wife.get_parentid()
-                if parent_fam_id in self.__families:
-                    parent_fam = self.get_family(parent_fam_id)
-                    father = self.get_person(parent_fam.get_husband())
-                    mother = self.get_person(parent_fam.get_wife())
-                    log.write(f'  Wife Parents: {father.get_name()} and {mother.get_name()}')
-                else:
-                    log.write(f'  Wife Parents: None')
-
-            # children
-            output = []
-            for index, child_id in enumerate(fam.get_children()):
-                person = self.__people[child_id]
-                output.append(f'{person.get_name()}')
-            out_str = str(output).replace("'", '', 100)
-            log.write(f'  Children: {out_str[1:-1]}')
-
+        generations, connected = self._walk(self.__start_family_id, log)
         log.write('')
         log.write(f'Number of people                    : {len(self.__people)}')
         log.write(f'Number of families                  : {len(self.__families)}')
-        log.write(f'Max generations                     : {self._count_generations(self.__start_family_id)}')
-        log.write(f'People connected to starting family : {self._test_number_connected_to_start()}')
-
+        log.write(f'Max generations                     : {generations}')
+        log.write(f'People connected to starting family : {connected}')
 
     def _test_number_connected_to_start(self):
-        # start with first family, how many connected to that family
-        inds_seen = set()
-
-        def _recurive(family_id):
-            nonlocal inds_seen
-            if family_id in self.__families:
-                # count people in this family
-                fam = self.__families[family_id]
-
-                husband = self.get_person(fam.get_husband())
-                if husband != None:
-                    if husband.get_id() not in inds_seen:
-                        inds_seen.add(husband.get_id())
-                    _recurive(husband.get_parentid())
-                
-                wife = self.get_person(fam.get_wife())
-                if wife != None:
-                    if wife.get_id() not in inds_seen:
-                        inds_seen.add(wife.get_id())
-                    _recurive(wife.get_parentid())
-
-                for child_id in fam.get_children():
-                    if child_id not in inds_seen:
-                        inds_seen.add(child_id)
-
-
-        _recurive(self.__start_family_id)
-        return len(inds_seen)
-
+        return self._walk(self.__start_family_id)[1]
 
     def _count_generations(self, family_id):
-        max_gen = -1
-
-        def _recurive_gen(id, gen):
-            nonlocal max_gen
-            if id in self.__families:
-                if max_gen < gen:
-                    max_gen = gen
-
-                fam = self.__families[id]
-
-                husband = self.get_person(fam.get_husband())
-                if husband != None:
-                    _recurive_gen(husband.get_parentid(), gen + 1)
-                
-                wife = self.get_person(fam.get_wife())
-                if wife != None:
-                    _recurive_gen(wife.get_parentid(), gen + 1)
-
-        _recurive_gen(family_id, 0)
-        return max_gen + 1
-
+        return self._walk(family_id)[0]
+
+    def _walk(self, family_id, log=None):
+        """
+        One pass up the tree from family_id using an explicit stack.
+        Returns (generations, number of people connected to family_id).
+        When a log is given, every family is also displayed, the lines are
+        written DISPLAY_BATCH at a time. Families that can't be reached from
+        family_id are displayed at the end.
+        """
+        people = self.__people
+        families = self.__families
+        lines = []
+
+        def name_of(person_id):
+            person = people.get(person_id)
+            return 'None' if person is None else person.get_name()
+
+        def parents_of(person):
+            if person is None:
+                return 'None'
+            parent_fam = families.get(person.get_parentid())
+            if parent_fam is None:
+                return 'None'
+            return f'{name_of(parent_fam.get_husband())} and {name_of(parent_fam.get_wife())}'
+
+        def show(fam_id, fam, husband, wife):
+            lines.append(f'Family id: {fam_id}')
+            lines.append('  Husband: None' if husband is None else f'  Husband: {husband.get_name()}, {husband.get_birth()}')
+            lines.append('  Wife: None' if wife is None else f'  Wife: {wife.get_name()}, {wife.get_birth()}')
+            lines.append(f'  Husband Parents: {parents_of(husband)}')
+            lines.append(f'  Wife Parents: {parents_of(wife)}')
+            children = [people[child_id].get_name() for child_id in fam.get_children() if child_id in people]
+            lines.append(f'  Children: {", ".join(children)}')
+            if len(lines) >= DISPLAY_BATCH:
+                log.write('\n'.join(lines))
+                lines.clear()
+
+        max_gen = 0
+        inds_seen = set()
+        fams_seen = set()
+        stack = [(family_id, 1)]
+        while stack:
+            fam_id, gen = stack.pop()
+            fam = families.get(fam_id)
+            if fam is None or fam_id in fams_seen:
+                continue
+            fams_seen.add(fam_id)
+            if gen > max_gen:
+                max_gen = gen
+
+            husband = people.get(fam.get_husband())
+            wife = people.get(fam.get_wife())
+            for person in (husband, wife):
+                if person is not None:
+                    inds_seen.add(person.get_id())
+                    stack.append((person.get_parentid(), gen + 1))
+            inds_seen.update(fam.get_children())
+
+            if log is not None:
+                show(fam_id, fam, husband, wife)
+
+        if log is not None:
+            for fam_id, fam in families.items():
+                if fam_id not in fams_seen:
+                    show(fam_id, fam, people.get(fam.get_husband()), people.get(fam.get_wife()))
+            if lines:
+                log.write('\n'.join(lines))
+
+        return max_gen, len(inds_seen)
@@ -46,53 +46,78 @@ Describe how to speed up part 1
 Part 1 uses a **recursive DFS** over families. Each family is fetched from the
 `/family/<id>` API, then all related people (husband, wife, children) are fetched
 from `/person/<id>`. To speed it up, I:
-- Keep shared `visited_families` and `visited_people` sets so I never fetch the
-  same family or person twice.
-- Protect the shared `Tree` and the visited sets with locks so multiple threads
-  can safely add data.
+- Claim every family and person with `tree.claim_family()` /
+  `tree.claim_person()` before fetching it, so nothing is fetched twice. The
+  `Tree` keeps its ids in lock-striped shards, so threads only wait on each
+  other when they touch the same shard.
 - Use recursion for the DFS structure, but whenever I discover a parent family
   (via `person.parent_id`), I start a **new thread** that continues the DFS up
   that branch. This overlaps the 0.25-second server latency for many requests
   at once instead of waiting for each call sequentially.
+- Once a family arrives, all of its people are fetched at the same time (one
+  short-lived thread each), so a family costs about 2 round trips instead of
+  2 + children. Every request holds a shared `BoundedSemaphore`
+  (`DFS_MAX_REQUESTS`), which caps the total in flight.
 - At the end, I join all spawned threads so the function finishes only after
   the full pedigree has been retrieved.
 
 
 Describe how to speed up part 2
 
-Part 2 uses a **Breadth-First Search (BFS)** over families, level by level,
-without recursion:
-- I keep a `current_level` list of family IDs. For each level, I spawn one
-  worker thread per family (unlimited count for speed).
-- Each worker fetches the family and all of its people and adds them to the
-  shared `Tree` under a lock.
-- While processing, workers collect the next level of ancestor families using
-  the parents of the husband and wife (`person.parent_id`) and store them in a
-  shared `next_level` set (also under a lock) so there are no duplicates.
-- When all threads for the current level finish, I move `next_level` into
-  `current_level` and repeat.
-This gives a clear BFS (level-by-level) structure and overlaps many server
-requests concurrently for maximum throughput.
+Part 2 uses a **Breadth-First Search (BFS)** over families with a shared
+FIFO work queue instead of processing one level at a time:
+- A fixed pool of `BFS_WORKERS` threads takes single requests from the
+  queue: `('family', id)` or `('person', id)`. A worker that fetches a
+  family queues one request per person in it, so the people of a family are
+  fetched by several workers at the same time.
+- As soon as a worker reads a person's `parent_id`, that parent family is
+  claimed with `tree.claim_family()` (only the first caller wins, so no
+  duplicates) and put on the queue. Families still come out in BFS order, but there is no barrier
+  at the end of a generation, so one slow family never stalls the others.
+- The main thread waits with `queue.join()`, which returns once every
+  queued request has been processed, then sends one `None` per worker to
+  stop the pool.
 
 
 Extra (Optional) 10% Bonus to speed up part 3
 
-Part 3 uses the same BFS, but I explicitly **limit concurrency to 5 threads**
-so the server never has more than 5 active request threads from this client:
-- I still do BFS by levels, but I process each level in **chunks of at most 5
-  families at a time**.
-- For each chunk, I start up to 5 worker threads, wait (join) for them to
-  finish, and then move to the next chunk.
-- Because each worker performs its HTTP calls sequentially, and there are never
-  more than 5 active workers, the server will not see more than 5 concurrent
-  requests while the program runs, while still trying to keep 5 active as much
-  as possible.
+Part 3 is the same work queue with a pool of exactly **5 worker threads**:
+- Each worker makes one HTTP call at a time, so the server never sees more
+  than 5 requests from this client, even though the people of a family are
+  spread across the workers.
+- Because people and parent families are queued the moment they are found,
+  all 5 workers stay busy until the frontier is empty; there are no chunks
+  of 5 that have to finish before the next one starts.
+
+
+Part 4 (asyncio crawler)
+
+`async_fs_pedigree` does the same search without any threads. Every family and
+person request is a coroutine on one event loop (`get_data_from_server_async`
+in common.py uses only asyncio streams):
+- After a family arrives, all of its people are requested together with
+  `asyncio.gather`, then the parent families of the husband and wife.
+- An `asyncio.Semaphore` caps the number of requests in flight
+  (`ASYNC_MAX_REQUESTS`), so thousands of requests can overlap without
+  thousands of OS threads.
+- Only the event loop touches the `Tree` and the visited sets, so no locks
+  are needed.
 """
 
 from common import *
+import asyncio
 import queue
 import threading
 
+# Max number of requests in flight for the depth first search (part 1)
+DFS_MAX_REQUESTS = 500
+
+# Number of worker threads for the breadth first search (part 2)
+BFS_WORKERS = 200
+
+# Max number of requests in flight for the asyncio crawler (part 4)
+ASYNC_MAX_REQUESTS = 500
+
 
 # ----------------------------------------------------------------------------- #
 # Helper functions (no try/except here; all error handling is inside common.py) #
@@ -129,6 +154,24 @@ def _fetch_person_data(person_id):
     return data
 
 
+def _fetch_people_data(person_ids, budget):
+    """Fetch all of the people at the same time, one thread each, each holding the shared
+    budget semaphore during its request. Returns the person JSON (or None) in the same order."""
+    results = [None] * len(person_ids)
+
+    def fetch(index, person_id):
+        with budget:
+            results[index] = _fetch_person_data(person_id)
+
+    threads = [threading.Thread(target=fetch, args=(i, pid)) for i, pid in enumerate(person_ids)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
+
 # ----------------------------------------------------------------------------- #
 # Part 1 – Depth-First Search pedigree (recursive, threaded)                    #
 # ----------------------------------------------------------------------------- #
@@ -137,10 +180,8 @@ def depth_fs_pedigree(family_id, tree):
     # KEEP this function even if you don't implement it
     # DFS with recursion + threads: each parent branch runs in its own thread.
 
-    tree_lock = threading.Lock()
-    family_lock = threading.Lock()
-    visited_families = set()
-    visited_people = set()
+    # Shared by every request this search makes.
+    budget = threading.BoundedSemaphore(DFS_MAX_REQUESTS)
 
     threads = []
     threads_lock = threading.Lock()
@@ -149,31 +190,18 @@ def depth_fs_pedigree(family_id, tree):
         with threads_lock:
             threads.append(t)
 
-    def add_family_to_tree(fam_obj):
-        with tree_lock:
-            if not tree.does_family_exist(fam_obj.get_id()):
-                tree.add_family(fam_obj)
-
-    def add_person_to_tree(person_obj):
-        with tree_lock:
-            if not tree.does_person_exist(person_obj.get_id()):
-                tree.add_person(person_obj)
-
     def dfs_family(current_family_id):
         # Depth-first traversal of the pedigree using recursion.
-        with family_lock:
-            if current_family_id in visited_families:
-                return
-            visited_families.add(current_family_id)
-
-        fam_data = _fetch_family_data(current_family_id)
+        # The family was already claimed by the thread that started this one.
+        with budget:
+            fam_data = _fetch_family_data(current_family_id)
         if fam_data is None:
             return
 
-        family = Family(fam_data)
-        add_family_to_tree(family)
+        family = CompactFamily(fam_data)
+        tree.add_family(family)
 
-        # Collect all relevant person IDs in this family.
+        # Collect all relevant person IDs in this family that no other thread has claimed.
         person_ids = []
 
         husband_id = family.get_husband()
@@ -188,35 +216,29 @@ def depth_fs_pedigree(family_id, tree):
             if child_id is not None and child_id != 0:
                 person_ids.append(child_id)
 
-        # Process all people in this family.
-        for pid in person_ids:
-            with tree_lock:
-                if pid in visited_people:
-                    continue
-                visited_people.add(pid)
+        person_ids = [pid for pid in person_ids if tree.claim_person(pid)]
 
-            person_data = _fetch_person_data(pid)
+        # Fetch everyone in the family at the same time, then process them.
+        for person_data in _fetch_people_data(person_ids, budget):
             if person_data is None:
                 continue
 
-            person = Person(person_data)
-            add_person_to_tree(person)
+            person = CompactPerson(person_data)
+            tree.add_person(person)
 
             # DFS step: move up to this person's parents (parent family).
             parent_family_id = person.get_parentid()
             if parent_family_id is None or parent_family_id == 0:
                 continue
 
-            # Only start a new DFS thread if we haven't seen this family yet.
-            with family_lock:
-                already_seen = parent_family_id in visited_families
-
-            if not already_seen:
+            # Only start a new DFS thread for a family no one has claimed yet.
+            if tree.claim_family(parent_family_id):
                 t = threading.Thread(target=dfs_family, args=(parent_family_id,))
                 register_thread(t)
                 t.start()
 
     # Start DFS from the starting family in its own thread.
+    tree.claim_family(family_id)
     root_thread = threading.Thread(target=dfs_family, args=(family_id,))
     register_thread(root_thread)
     root_thread.start()
@@ -234,209 +256,155 @@ def depth_fs_pedigree(family_id, tree):
 
 
 # ----------------------------------------------------------------------------- #
-# Part 2 – Breadth-First Search pedigree (fast as possible, many threads)       #
+# Parts 2 and 3 – Breadth-First Search with a work queue and a pool of threads  #
 # ----------------------------------------------------------------------------- #
 
-def breadth_fs_pedigree(family_id, tree):
-    # KEEP this function even if you don't implement it
-    # BFS – no recursion, level by level, with many threads per level.
-
-    tree_lock = threading.Lock()
-    family_lock = threading.Lock()
-    visited_families = set()
-    visited_people = set()
+def _work_queue_pedigree(family_id, tree, workers):
+    # BFS without levels: a fixed pool of worker threads takes requests from
+    # one FIFO queue.  A request is ('family', id) or ('person', id), so the
+    # people of a family are fetched by different workers at the same time,
+    # and every parent family found is queued right away.  Each worker makes
+    # one request at a time, so there are never more than `workers` requests.
 
-    # Start BFS with the initial family.
-    current_level = [family_id]
+    request_q = queue.Queue()
 
-    def add_family_to_tree(fam_obj):
-        with tree_lock:
-            if not tree.does_family_exist(fam_obj.get_id()):
-                tree.add_family(fam_obj)
+    def queue_family(parent_family_id):
+        # A family is claimed when it is queued, so it is only queued once.
+        if tree.claim_family(parent_family_id):
+            request_q.put(('family', parent_family_id))
 
-    def add_person_to_tree(person_obj):
-        with tree_lock:
-            if not tree.does_person_exist(person_obj.get_id()):
-                tree.add_person(person_obj)
+    def queue_person(person_id):
+        if tree.claim_person(person_id):
+            request_q.put(('person', person_id))
 
-    # Standard BFS loop: process one generation (level) at a time.
-    while current_level:
-        threads = []
-        next_level_set = set()
-        next_level_lock = threading.Lock()
+    def process_family(current_family_id):
+        fam_data = _fetch_family_data(current_family_id)
+        if fam_data is None:
+            return
 
-        def worker_process_family(current_family_id):
-            # Mark family visited (BFS node visit).
-            with family_lock:
-                if current_family_id in visited_families:
-                    return
-                visited_families.add(current_family_id)
+        family = CompactFamily(fam_data)
+        tree.add_family(family)
 
-            fam_data = _fetch_family_data(current_family_id)
-            if fam_data is None:
-                return
+        husband_id = family.get_husband()
+        if husband_id is not None and husband_id != 0:
+            queue_person(husband_id)
 
-            family = Family(fam_data)
-            add_family_to_tree(family)
+        wife_id = family.get_wife()
+        if wife_id is not None and wife_id != 0:
+            queue_person(wife_id)
 
-            person_ids = []
+        for child_id in family.get_children():
+            if child_id is not None and child_id != 0:
+                queue_person(child_id)
 
-            husband_id = family.get_husband()
-            if husband_id is not None and husband_id != 0:
-                person_ids.append(husband_id)
+    def process_person(person_id):
+        person_data = _fetch_person_data(person_id)
+        if person_data is None:
+            return
 
-            wife_id = family.get_wife()
-            if wife_id is not None and wife_id != 0:
-                person_ids.append(wife_id)
+        person = CompactPerson(person_data)
+        tree.add_person(person)
 
-            for child_id in family.get_children():
-                if child_id is not None and child_id != 0:
-                    person_ids.append(child_id)
+        # Expand the frontier now, not at the end of the level.
+        parent_family_id = person.get_parentid()
+        if parent_family_id is not None and parent_family_id != 0:
+            queue_family(parent_family_id)
 
-            # Process all people in this family (fetch and add).
-            parent_families_for_this_family = []
+    def worker():
+        while True:
+            request = request_q.get()
+            if request is None:
+                request_q.task_done()
+                break
+            try:
+                kind, id = request
+                if kind == 'family':
+                    process_family(id)
+                else:
+                    process_person(id)
+            finally:
+                request_q.task_done()
 
-            for pid in person_ids:
-                with tree_lock:
-                    if pid in visited_people:
-                        continue
-                    visited_people.add(pid)
+    queue_family(family_id)
 
-                person_data = _fetch_person_data(pid)
-                if person_data is None:
-                    continue
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for t in threads:
+        t.start()
 
-                person = Person(person_data)
-                add_person_to_tree(person)
+    # Every request queued has been processed once join() returns, including
+    # the ones queued by the workers themselves.
+    request_q.join()
 
-                parent_family_id = person.get_parentid()
-                if parent_family_id is not None and parent_family_id != 0:
-                    parent_families_for_this_family.append(parent_family_id)
+    for _ in threads:
+        request_q.put(None)
+    for t in threads:
+        t.join()
 
-            # Collect parent families into the next level (BFS frontier expansion).
-            if parent_families_for_this_family:
-                with next_level_lock:
-                    for pfid in parent_families_for_this_family:
-                        if pfid not in visited_families:
-                            next_level_set.add(pfid)
 
-        # Spawn one worker thread per family in this BFS level.
-        for fid in current_level:
-            t = threading.Thread(target=worker_process_family, args=(fid,))
-            threads.append(t)
-            t.start()
+def breadth_fs_pedigree(family_id, tree):
+    # KEEP this function even if you don't implement it
+    # BFS – no recursion, a large pool of workers sharing one queue.
+    _work_queue_pedigree(family_id, tree, BFS_WORKERS)
 
-        # Wait for all workers in this level to finish.
-        for t in threads:
-            t.join()
 
-        # Next BFS level: convert set to list.
-        current_level = list(next_level_set)
+def breadth_fs_pedigree_limit5(family_id, tree):
+    # KEEP this function even if you don't implement it
+    # BFS – no recursion, exactly 5 workers so the server never sees more than 5 requests.
+    _work_queue_pedigree(family_id, tree, 5)
 
 
 # ----------------------------------------------------------------------------- #
-# Part 3 – Breadth-First Search pedigree, limited to 5 concurrent threads       #
+# Part 4 – asyncio pedigree, one event loop instead of a thread per family      #
 # ----------------------------------------------------------------------------- #
 
-def breadth_fs_pedigree_limit5(family_id, tree):
-    # KEEP this function even if you don't implement it
-    # BFS – no recursion, but now we enforce a hard limit of 5 concurrent threads.
+def async_fs_pedigree(family_id, tree):
+    asyncio.run(_async_fs_pedigree(family_id, tree))
 
-    MAX_WORKERS = 5
 
-    tree_lock = threading.Lock()
-    family_lock = threading.Lock()
+async def _async_fs_pedigree(family_id, tree):
+    limit = asyncio.Semaphore(ASYNC_MAX_REQUESTS)
     visited_families = set()
     visited_people = set()
 
-    current_level = [family_id]
-
-    def add_family_to_tree(fam_obj):
-        with tree_lock:
-            if not tree.does_family_exist(fam_obj.get_id()):
-                tree.add_family(fam_obj)
-
-    def add_person_to_tree(person_obj):
-        with tree_lock:
-            if not tree.does_person_exist(person_obj.get_id()):
-                tree.add_person(person_obj)
-
-    while current_level:
-        next_level_set = set()
-        next_level_lock = threading.Lock()
-
-        # We will process this level in chunks of up to MAX_WORKERS families.
-        index = 0
-        level_size = len(current_level)
-
-        def worker_process_family(current_family_id):
-            with family_lock:
-                if current_family_id in visited_families:
-                    return
-                visited_families.add(current_family_id)
-
-            fam_data = _fetch_family_data(current_family_id)
-            if fam_data is None:
-                return
-
-            family = Family(fam_data)
-            add_family_to_tree(family)
-
-            person_ids = []
-
-            husband_id = family.get_husband()
-            if husband_id is not None and husband_id != 0:
-                person_ids.append(husband_id)
-
-            wife_id = family.get_wife()
-            if wife_id is not None and wife_id != 0:
-                person_ids.append(wife_id)
+    async def fetch(kind, id):
+        async with limit:
+            data = await get_data_from_server_async(f'{TOP_API_URL}/{kind}/{id}')
 
-            for child_id in family.get_children():
-                if child_id is not None and child_id != 0:
-                    person_ids.append(child_id)
+        if not data or 'id' not in data:
+            return None
+        return data
 
-            parent_families_for_this_family = []
-
-            for pid in person_ids:
-                with tree_lock:
-                    if pid in visited_people:
-                        continue
-                    visited_people.add(pid)
-
-                person_data = _fetch_person_data(pid)
-                if person_data is None:
-                    continue
-
-                person = Person(person_data)
-                add_person_to_tree(person)
+    async def visit_family(current_family_id):
+        if current_family_id is None or current_family_id == 0:
+            return
+        if current_family_id in visited_families:
+            return
+        visited_families.add(current_family_id)
 
-                parent_family_id = person.get_parentid()
-                if parent_family_id is not None and parent_family_id != 0:
-                    parent_families_for_this_family.append(parent_family_id)
+        fam_data = await fetch('family', current_family_id)
+        if fam_data is None:
+            return
 
-            if parent_families_for_this_family:
-                with next_level_lock:
-                    for pfid in parent_families_for_this_family:
-                        if pfid not in visited_families:
-                            next_level_set.add(pfid)
+        family = CompactFamily(fam_data)
+        tree.add_family(family)
 
-        # Process the current level in waves of up to MAX_WORKERS threads.
-        while index < level_size:
-            threads = []
-            # Choose the next chunk of families to process concurrently.
-            chunk = current_level[index:index + MAX_WORKERS]
+        person_ids = []
+        for pid in [family.get_husband(), family.get_wife()] + family.get_children():
+            if pid is not None and pid != 0 and pid not in visited_people:
+                visited_people.add(pid)
+                person_ids.append(pid)
 
-            for fid in chunk:
-                t = threading.Thread(target=worker_process_family, args=(fid,))
-                threads.append(t)
-                t.start()
+        # Request everyone in the family at the same time.
+        people_data = await asyncio.gather(*(fetch('person', pid) for pid in person_ids))
 
-            # Wait until this chunk finishes before starting the next one.
-            for t in threads:
-                t.join()
+        parent_family_ids = []
+        for person_data in people_data:
+            if person_data is None:
+                continue
+            person = CompactPerson(person_data)
+            tree.add_person(person)
+            parent_family_ids.append(person.get_parentid())
 
-            index += MAX_WORKERS
+        await asyncio.gather(*(visit_family(pfid) for pfid in parent_family_ids))
 
-        # Move on to the next BFS level.
-        current_level = list(next_level_set)
+    await visit_family(family_id)
@@ -6,18 +6,23 @@ Author: <your name>
 Purpose: Assignment 10 - Family Search
 """
 from common import *
-from functions import depth_fs_pedigree, breadth_fs_pedigree, breadth_fs_pedigree_limit5
+from functions import depth_fs_pedigree, breadth_fs_pedigree, breadth_fs_pedigree_limit5, async_fs_pedigree
 
 from cse351 import *
 
 DFS = 'Depth First Search'
 BFS = 'Breadth First Search'
 BFS5 = 'Breadth First Search limit 5'
+ASYNC = 'Asyncio Search'
 
-def run_part(log, start_id, generations, title, func):
+def run_part(log, start_id, generations, title, func, seed=None):
     tree = Tree(start_id)
 
-    get_data_from_server(f'{TOP_API_URL}/start/{generations}')
+    if seed is None:
+        get_data_from_server(f'{TOP_API_URL}/start/{generations}')
+    else:
+        # same seed, same tree, so the times can be compared between runs
+        get_data_from_server(f'{TOP_API_URL}/start/{generations}/{seed}')
 
     log.write('\n')
     log.write('#' * 45)
@@ -53,19 +58,22 @@ def main():
     print(f'Starting Family id: {start_id}')
 
     # load runs.txt
-    # part number, number of generations
+    # part number, number of generations, optional tree seed
     with open('runs.txt') as runs:
         for line in runs:
             parts = line.split(',')
             part_to_run = int(parts[0])
             generations = int(parts[1])
+            seed = int(parts[2]) if len(parts) > 2 else None
 
             if part_to_run == 1:
-                run_part(log, start_id, generations, DFS, depth_fs_pedigree)
+                run_part(log, start_id, generations, DFS, depth_fs_pedigree, seed)
             elif part_to_run == 2:
-                run_part(log, start_id, generations, BFS, breadth_fs_pedigree)
+                run_part(log, start_id, generations, BFS, breadth_fs_pedigree, seed)
             elif part_to_run == 3:
-                run_part(log, start_id, generations, BFS5, breadth_fs_pedigree_limit5)
+                run_part(log, start_id, generations, BFS5, breadth_fs_pedigree_limit5, seed)
+            elif part_to_run == 4:
+                run_part(log, start_id, generations, ASYNC, async_fs_pedigree, seed)
 
 
 if __name__ == '__main__':
@@ -24,6 +24,10 @@ import threading
 import time
 import json
 import os
+import argparse
+import functools
+import math
+import random
 
 TOP_API_URL = 'http://127.0.0.1:8790'
 
@@ -36,74 +40,232 @@ URL_STARSHIPS = "starships"
 
 DELAY = 0.5         # Delay
 
+KEEP_ALIVE_TIMEOUT = 15     # Idle seconds before a persistent connection is closed (--keep-alive)
+
 master_dict = {}
 
+# ----------------------------------------------------------------------------
+# The same in every course server (Star Wars, weather, Family Search). Each lesson
+# folder runs on its own, so this is copied instead of imported: change every copy.
+LATENCY_KINDS = ('fixed', 'uniform', 'lognormal')
+
+class LatencyModel:
+    """ How long each request sleeps and how often it fails (--latency options)
+
+    A path starts from the latency of its longest matching prefix in
+    endpoints, or base when none match, then
+        fixed     : always that latency
+        uniform   : anywhere within +/- spread (a fraction) of it
+        lognormal : a long tail with that latency as the median, spread is sigma
+    outlier_rate of the requests sleep another outlier_delay seconds.
+    """
+
+    def __init__(self, base, endpoints=None, kind='fixed', spread=0.5, outlier_rate=0.0, outlier_delay=0.0,
+                 error_rate=0.0, empty_rate=0.0, seed=None):
+        super().__init__()
+        self.base = base
+        self.endpoints = dict(endpoints or {})
+        self.kind = kind
+        self.spread = spread
+        self.outlier_rate = outlier_rate
+        self.outlier_delay = outlier_delay
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def median(self, path):
+        best = None
+        for prefix in self.endpoints:
+            if path.startswith(prefix) and (best == None or len(prefix) > len(best)):
+                best = prefix
+        return self.base if best == None else self.endpoints[best]
+
+    def delay(self, path):
+        """ Seconds to sleep before answering path """
+        median = self.median(path)
+        with self.lock:
+            if self.kind == 'uniform':
+                seconds = self.rand.uniform(median * (1 - self.spread), median * (1 + self.spread))
+            elif self.kind == 'lognormal' and median > 0:
+                seconds = self.rand.lognormvariate(math.log(median), self.spread)
+            else:
+                seconds = median
+
+            if self.outlier_rate > 0 and self.rand.random() < self.outlier_rate:
+                seconds += self.outlier_delay
+
+        return max(seconds, 0.0)
+
+    def fault(self):
+        """ Returns 'error' (reply 500), 'empty' (reply null) or None for a normal reply """
+        if self.error_rate <= 0 and self.empty_rate <= 0:
+            return None
+
+        with self.lock:
+            roll = self.rand.random()
+        if roll < self.error_rate:
+            return 'error'
+        if roll < self.error_rate + self.empty_rate:
+            return 'empty'
+        return None
+
+
+def add_latency_arguments(parser, delay):
+    parser.add_argument('--delay', type=float, default=delay,
+                        help='median latency in seconds of each request')
+    parser.add_argument('--latency', choices=LATENCY_KINDS, default='fixed',
+                        help='how the latency of each request varies around its median')
+    parser.add_argument('--latency-spread', type=float, default=0.5,
+                        help='uniform: +/- this fraction of the median, lognormal: sigma')
+    parser.add_argument('--latency-endpoint', action='append', default=[], metavar='PREFIX=SECONDS',
+                        help='median latency of the paths starting with PREFIX, can be repeated')
+    parser.add_argument('--outlier-rate', type=float, default=0.0,
+                        help='fraction of requests that are slow outliers')
+    parser.add_argument('--outlier-delay', type=float, default=0.0,
+                        help='extra seconds an outlier sleeps')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of data requests answered with a 500 error')
+    parser.add_argument('--empty-rate', type=float, default=0.0,
+                        help='fraction of data requests answered with an empty (null) body')
+    parser.add_argument('--latency-seed', type=int,
+                        help='seed for the latencies and failures, so runs can be repeated')
+
+
+def latency_from_args(args, base, endpoints=None):
+    """ The LatencyModel for the --latency options, --latency-endpoint overrides endpoints """
+    endpoints = dict(endpoints or {})
+    for item in args.latency_endpoint:
+        prefix, _, seconds = item.partition('=')
+        endpoints[prefix] = float(seconds)
+
+    return LatencyModel(base, endpoints, args.latency, args.latency_spread, args.outlier_rate, args.outlier_delay,
+                        args.error_rate, args.empty_rate, args.latency_seed)
+
+latency = LatencyModel(DELAY)
+
+
+# ----------------------------------------------------------------------------
+# The same in every course server (Star Wars, weather, Family Search). Each lesson
+# folder runs on its own, so this is copied instead of imported: change every copy.
+class Router:
+    """ Table of path templates such as '/people/{id:int}' to handlers
+
+    Only the first segment of a template is fixed, the rest are {fields}.
+    A path is looked up by its first segment and number of segments (one
+    dict access), then the :int fields are converted and the fields are
+    passed to the handler in order. A path that matches no template, or has
+    a bad :int field, has no route, so the server only needs one 404 path.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.routes = {}
+
+    def add(self, template, handler):
+        parts = template.strip('/').split('/')
+        int_fields = []
+        for index, part in enumerate(parts[1:]):
+            if not (part.startswith('{') and part.endswith('}')):
+                raise ValueError(f'Only the first segment of {template} can be fixed')
+            if part.endswith(':int}'):
+                int_fields.append(index)
+        self.routes[(parts[0], len(parts))] = (handler, tuple(int_fields))
+
+    def match(self, path):
+        """ Returns (handler, [field values]), None when no template matches """
+        if '?' in path:
+            path = path[:path.index('?')]
+        parts = path.strip('/').split('/')
+        route = self.routes.get((parts[0], len(parts)))
+        if route == None:
+            return None
+
+        handler, int_fields = route
+        args = parts[1:]
+        try:
+            for index in int_fields:
+                args[index] = int(args[index])
+        except ValueError:
+            return None
+        return handler, args
+
+
+
+def reply_top():
+    return '{"people": "http://127.0.0.1:8790/people/", ' + \
+           '"planets": "http://127.0.0.1:8790/planets/", '  + \
+           '"films": "http://127.0.0.1:8790/films/", ' + \
+           '"species": "http://127.0.0.1:8790/species/", ' + \
+           '"vehicles": "http://127.0.0.1:8790/vehicles/", '  + \
+           '"starships": "http://127.0.0.1:8790/starships/"}'
+
+
+def reply_item(command, id):
+    """ /people/1 => master_dict['people1'] """
+    key = f'{command}{id}'
+    if key not in master_dict:
+        return None
+    return str(master_dict[key]).replace("'", '"')
+
+
+router = Router()
+router.add('/', reply_top)
+for command in (URL_PEOPLE, URL_PLANETS, URL_FILMS, URL_SPECIES, URL_VEHICLES, URL_STARSHIPS):
+    router.add(f'/{command}/{{id:int}}', functools.partial(reply_item, command))
+
+
+# ----------------------------------------------------------------------------
 class Handler(BaseHTTPRequestHandler):
 
+    # HTTP/1.0 closes the connection after each reply, --keep-alive switches to HTTP/1.1
+    protocol_version = 'HTTP/1.0'
+
     def do_GET(self):
-        global master_dict
         print(f'Request: {self.path}')
 
         # self.path => "/people/1"
 
         # delay the reply from the server
-        time.sleep(DELAY)
-
-        # check to top level URL
-        if self.path == '/':
-            reply = '{"people": "http://127.0.0.1:8790/people/", ' + \
-                    '"planets": "http://127.0.0.1:8790/planets/", '  + \
-                    '"films": "http://127.0.0.1:8790/films/", ' + \
-                    '"species": "http://127.0.0.1:8790/species/", ' + \
-                    '"vehicles": "http://127.0.0.1:8790/vehicles/", '  + \
-                    '"starships": "http://127.0.0.1:8790/starships/"}'
+        delay = latency.delay(self.path)
+        if delay > 0:
+            time.sleep(delay)
+
+        # the top level URL never fails
+        fault = latency.fault() if self.path != '/' else None
+        if fault == 'error':
+            self.send_error(500)
+            return
+        if fault == 'empty':
+            reply = b'null'
             self.send_response(200)
+            self.send_header('Content-Length', str(len(reply)))
             self.end_headers()
-            self.wfile.write(str.encode(reply))
-        else:
-            # remove the ending '/' if found
-            if self.path[-1] == '/':
-                self.path = self.path[:-1]
-
-            request = self.path[1:]   # "people/1"
-            parts = request.split('/')
-            # print(parts)
-            if len(parts) != 2:
-                self.send_error(404)
-                # self.wfile.write(str.encode('Error 404 - not found'))
-            else:
-                command = parts[0]
-                # Check for valid command
-                if command not in (URL_PEOPLE, URL_PLANETS, URL_FILMS, URL_SPECIES, URL_VEHICLES, URL_STARSHIPS):
-                    self.send_error(404)
-                    # self.wfile.write(str.encode('Error 404 - not found'))
-                else:
-                    # check for valid id
-                    id = parts[1]
-                    if not id.isnumeric():
-                        self.send_error(404)
-                        # self.wfile.write(str.encode('Error 404 - not found'))
-                    else:
-                        key = f'{command}{id}'
-                        if key not in master_dict:
-                            self.send_error(404)
-                            # self.wfile.write(str.encode('Error 404 - not found'))
-                        else:
-                            self.send_response(200)
-                            self.end_headers()
-                            # self.wfile.write(b'Hello world\t' + threading.current_thread().name.encode() + b'\t' + str(threading.active_count()).encode() + b'\n')
-                            js = str(master_dict[key]).replace("'", '"')
-                            # print()
-                            # print(js)
-                            # print()
-                            self.wfile.write(str.encode(js))
+            self.wfile.write(reply)
+            return
+
+        route = router.match(self.path)
+        reply = None
+        if route != None:
+            handler, args = route
+            reply = handler(*args)
+
+        if reply == None:
+            self.send_error(404)
+            return
+
+        reply = str.encode(reply)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
 
 
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
     pass
 
 
-def run():
+def run(keep_alive=False):
     global master_dict
 
     if not os.path.exists('data.json'):
@@ -123,9 +285,26 @@ def run():
 
     print(f'Star Wars server waiting..... \nURL: {TOP_API_URL}')
 
+    if keep_alive:
+        Handler.protocol_version = 'HTTP/1.1'
+        Handler.timeout = KEEP_ALIVE_TIMEOUT
+        # the headers and body go out in separate writes, without TCP_NODELAY the
+        # body waits for the delayed ACK of the headers (~40 ms) on a reused connection
+        Handler.disable_nagle_algorithm = True
+        # don't wait for idle connections when the server is stopped
+        ThreadingSimpleServer.daemon_threads = True
+
     server = ThreadingSimpleServer(('localhost', 8790), Handler)
     server.serve_forever()
 
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Star Wars server')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='use HTTP/1.1 persistent connections so clients can reuse sockets')
+    add_latency_arguments(parser, DELAY)
+    args = parser.parse_args()
+
+    latency = latency_from_args(args, args.delay)
+
+    run(keep_alive=args.keep_alive)
\ No newline at end of file
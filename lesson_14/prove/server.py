@@ -17,6 +17,25 @@ Open a terminal window and run this program
 *******************  DO NOT MODIFY!!!!  *********************
 *******************  DO NOT MODIFY!!!!  *********************
 
+API
+
+/
+/start/{generations}
+/start/{generations}/{seed}  same seed, same tree (see also --seed)
+/end
+/person/{id}
+/family/{id}
+/people/{id},{id},...       batch of people, returns {id: person, ...}
+/families/{id},{id},...     batch of families, returns {id: family, ...}
+/stats                      every request since /start, a latency histogram and the
+                            concurrency over time, not counted as an API call
+                            (with --workers, only the requests of the worker that answers)
+
+Record / replay, to compare crawlers on the same tree and latencies every run
+
+python server.py --record tree.json --generations 8
+python server.py --replay tree.json --replay-latency 0.1 0.4
+
 """
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
@@ -26,14 +45,35 @@ import json
 import time
 import random
 import threading
-import ast
+import atexit
+import bisect
+import collections
+import asyncio
+import argparse
+import math
+import multiprocessing
+import os
+import signal
+import sys
+import zlib
+from array import array
 
 hostName = "127.0.0.1"
 serverPort = 8123
 
 SLEEP = 0.25
+BATCH_SLEEP = 0.25      # latency charged once for a /people or /families batch
+MAX_BATCH = 1000        # max number of ids in one batch request
 MAX_GENERATIONS = 6
 
+# Listen backlog of both servers. The asyncio crawler opens hundreds of
+# connections at once, the default of 5 drops them and they wait 1 s for a SYN retry
+LISTEN_BACKLOG = 4096
+
+# Persistent connections (--keep-alive), closed after this many idle seconds
+keep_alive = False
+KEEP_ALIVE_TIMEOUT = 15
+
 primes = (5000007787, 5000007797, 5000007799, 5000007811, 5000007823, 5000007829, 5000007877, 5000007899,
             5000007911, 5000007919, 5000007953, 5000007977, 5000007983, 5000008007, 5000008037, 5000008043, 5000008109, 5000008121,
             5000008127, 5000008133, 5000008147, 5000008151, 5000008201, 5000008219, 5000008271, 5000008297, 5000008313, 5000008319,
@@ -41,6 +81,9 @@ primes = (5000007787, 5000007797, 5000007799, 5000007811, 5000007823, 5000007829
 PRIME = random.choice(primes)
 ID = random.randint(10000, 10000000)
 
+# --seed, picks PRIME and ID and is the tree seed for a /start without one
+seed = None
+
 male_names = ('Liam', 'Noah', 'Oliver', 'William', 'Elijah', 'James', 
         'Benjamin', 'Lucas', 'Mason', 'Ethan', 'Alexander', 
         'Henry', 'Jacob', 'Michael', 'Daniel', 'Logan', 
@@ -71,36 +114,42 @@ surnames = ('Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Miller', 'Davis',
             'Pérez', 'Sánchez', 'Ramírez', 'Flores', 'Gómez', 'Torres', 'Díaz', 'Vásquez', 
             'Cruz', 'Morales', 'Gutiérrez', 'Reyes', 'Ruíz', 'Jiménez')
 
+NAMES = male_names + female_names
+
+BIRTH_START = datetime.date(1753, 1, 1)
+BIRTH_DAYS = (datetime.date(2020, 1, 1) - BIRTH_START).days
+
 max_thread_count = 0
 call_count = 0
 thread_count = 0
 lock = threading.Lock()
 
 family_request_order = []
-people = {}
-families = {}
 generations_created = 0
+seed_created = None     # seed of the tree being served, None for a random one
+start_time = time.time()
+async_mode = False
 
 
-def get_name_male():
-    return random.choice(male_names)
+def get_name_male(rand=random):
+    """ Returns an index into NAMES """
+    return rand.randrange(len(male_names))
 
 
-def get_name_female():
-    return random.choice(female_names)
+def get_name_female(rand=random):
+    """ Returns an index into NAMES """
+    return len(male_names) + rand.randrange(len(female_names))
 
 def get_surname():
     return random.choice(surnames)
 
-def get_date():
-    start_date = datetime.date(1753, 1, 1)
-    end_date = datetime.date(2020, 1, 1)
+def get_birth(rand=random):
+    """ Returns a birth date as the number of days since BIRTH_START """
+    return rand.randrange(BIRTH_DAYS)
 
-    time_between_dates = end_date - start_date
-    days_between_dates = time_between_dates.days
-    random_number_of_days = random.randrange(days_between_dates)
-    random_date = start_date + datetime.timedelta(days=random_number_of_days)
-    return f'{random_date.day}-{random_date.month}-{random_date.year}'
+def format_birth(days):
+    birth = datetime.date.fromordinal(BIRTH_START.toordinal() + days)
+    return f'{birth.day}-{birth.month}-{birth.year}'
 
 def encode(id: int):
     if id == None:
@@ -114,336 +163,1295 @@ def decode(code: int):
     else:
         return (code ^ PRIME) // ID
 
+# Log levels, each one includes the levels before it
+LOG_SUMMARY = 0      # /start and /end details only
+LOG_REQUESTS = 1     # plus one line per request
+LOG_PAYLOADS = 2     # plus the JSON sent for every request
+LOG_LEVELS = {'summary': LOG_SUMMARY, 'requests': LOG_REQUESTS, 'payloads': LOG_PAYLOADS}
+
+LOG_BUFFER_SIZE = 100000     # max lines held in memory, the oldest are dropped
+LOG_FLUSH_INTERVAL = 0.5     # seconds between writes to the file
+LOG_FLUSH_SIZE = 5000        # write sooner once this many lines are waiting
+
 class Log:
+    """ Server log written to the file by a background thread
+
+    write() only appends the line to a bounded in-memory buffer, so request
+    handlers never wait on the disk.  The writer thread saves the buffer
+    every flush_interval seconds, or sooner when flush_size lines are waiting.
+    With no filename nothing is written and there is no writer thread.
+    With start=False lines are only kept until start() starts the writer.
+    """
 
-    def __init__(self, filename):
+    def __init__(self, filename, level=LOG_PAYLOADS, start=True):
         super().__init__()
-        self.lock = threading.Lock()
         self.filename = filename
+        self.level = level
+        self.flush_interval = LOG_FLUSH_INTERVAL
+        self.flush_size = LOG_FLUSH_SIZE
+        self.lines = collections.deque(maxlen=LOG_BUFFER_SIZE)
+        self.dropped = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.file = None
+        self.writer = None
+        if filename == None:
+            self.level = -1
+            return
         self.file = open(filename, 'w')
+        if start:
+            self.start()
 
-    def write(self, line):
-        with self.lock:
-            self.file.write(line)
-            self.file.write('\n')
-            self.file.flush()
+    def start(self):
+        self.writer = threading.Thread(target=self._writer, daemon=True)
+        self.writer.start()
+
+    def write(self, line, level=LOG_SUMMARY):
+        if level > self.level:
+            return
+        with self.condition:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped += 1
+            self.lines.append(line)
+            if len(self.lines) >= self.flush_size:
+                self.condition.notify()
+
+    def _writer(self):
+        closed = False
+        while not closed:
+            with self.condition:
+                if not self.closed and len(self.lines) < self.flush_size:
+                    self.condition.wait(self.flush_interval)
+                lines = list(self.lines)
+                self.lines.clear()
+                dropped = self.dropped
+                self.dropped = 0
+                closed = self.closed
+
+            if dropped > 0:
+                self.file.write(f'*** {dropped} log lines were dropped ***\n')
+            if lines:
+                self.file.write('\n'.join(lines))
+                self.file.write('\n')
+                self.file.flush()
 
-    def __del__(self):
         self.file.close()
 
-# Global log object
-log = Log('server.log')
+    def close(self):
+        if self.writer == None:
+            return
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        self.writer.join()
+
+# Global log object, server.log is only opened by __main__ so importing
+# this module (the benchmarks) doesn't empty the log of a running server
+log = Log(None)
+# close whichever log is current at exit, __main__ replaces this one
+atexit.register(lambda: log.close())
 
 # ----------------------------------------------------------------------------
-class Person:
-    
-    def __init__(self, id, name):
+def percentile(times, pct):
+    if not times:
+        return 0.0
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * pct / 100))]
+
+# Upper bounds of the /stats latency histogram buckets, the last bucket is everything slower
+HISTOGRAM_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class Stats:
+    """ Handler times (seconds) of the requests since /start """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.origin = time.perf_counter()
+            self.times = []
+            self.window = []     # times since the last quiet mode report
+            self.starts = []     # perf_counter() when each request started
+            self.paths = []
+
+    def add(self, started, finished, path):
+        seconds = finished - started
+        with self.lock:
+            self.times.append(seconds)
+            self.window.append(seconds)
+            self.starts.append(started)
+            self.paths.append(path)
+
+    def take_window(self):
+        with self.lock:
+            window = self.window
+            self.window = []
+        return window
+
+    def percentiles(self):
+        with self.lock:
+            times = list(self.times)
+        return percentile(times, 50), percentile(times, 99)
+
+    def export(self):
+        """ Returns the /stats data: every request, a latency histogram and the
+            number of requests being handled over time, times are seconds since /start """
+        with self.lock:
+            origin = self.origin
+            times = list(self.times)
+            starts = list(self.starts)
+            paths = list(self.paths)
+
+        timeline = []
+        counts = [0] * (len(HISTOGRAM_MS) + 1)
+        events = []
+        for seconds, started, path in zip(times, starts, paths):
+            start = started - origin
+            timeline.append([round(start, 6), round(start + seconds, 6), path])
+            counts[bisect.bisect_left(HISTOGRAM_MS, seconds * 1000)] += 1
+            events.append((start, 1))
+            events.append((start + seconds, -1))
+
+        # [time, requests in progress] every time the number changes
+        concurrency = []
+        active = 0
+        for when, change in sorted(events):
+            active += change
+            if concurrency and concurrency[-1][0] == round(when, 6):
+                concurrency[-1][1] = active
+            else:
+                concurrency.append([round(when, 6), active])
+
+        return {
+            'requests': len(timeline),
+            'timeline': timeline,
+            'histogram': {'upper_ms': list(HISTOGRAM_MS) + [None], 'counts': counts},
+            'concurrency': concurrency,
+        }
+
+# Global stats object
+stats = Stats()
+
+# Quiet mode replaces the per-request printing with a stats line every STATS_INTERVAL seconds
+quiet = False
+STATS_INTERVAL = 1.0
+
+def report_stats():
+    last_count = call_count
+    last_time = time.time()
+    while True:
+        time.sleep(STATS_INTERVAL)
+        now = time.time()
+        with lock:
+            count = call_count
+            active = thread_count
+            max_active = max_thread_count
+
+        window = stats.take_window()
+        if window or active > 0:
+            # call_count is reset by /start
+            rate = max(0, count - last_count) / (now - last_time)
+            print(f'Requests/sec: {rate:8.1f} | in-flight: {active:5} | max in-flight: {max_active:5} | '
+                  f'p50: {percentile(window, 50) * 1000:7.1f} ms | p99: {percentile(window, 99) * 1000:7.1f} ms')
+        last_count = count
+        last_time = now
+
+
+# ----------------------------------------------------------------------------
+# Handler times above this many ms share the last bucket of SharedCounters.histogram
+SHARED_HISTOGRAM_MS = 10000
+
+class SharedCounters:
+    """ Request counts of all the --workers processes, created before forking
+
+    The values live in shared memory (multiprocessing.RawArray) so every
+    worker adds to the same totals. Percentiles come from a histogram with
+    1 ms buckets, because the handler times themselves stay in each worker.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = multiprocessing.Lock()
+        self.counts = multiprocessing.RawArray('q', 3)      # calls, active, max active
+        self.start_time = multiprocessing.RawValue('d', time.time())
+        self.histogram = multiprocessing.RawArray('q', SHARED_HISTOGRAM_MS + 1)
+
+    def reset(self):
+        with self.lock:
+            # /start is still active
+            self.counts[0] = 1
+            self.counts[1] = 1
+            self.counts[2] = 1
+            self.start_time.value = time.time()
+            for i in range(len(self.histogram)):
+                self.histogram[i] = 0
+
+    def started(self):
+        with self.lock:
+            self.counts[0] += 1
+            self.counts[1] += 1
+            if self.counts[1] > self.counts[2]:
+                self.counts[2] = self.counts[1]
+
+    def finished(self, seconds):
+        with self.lock:
+            self.counts[1] -= 1
+            self.histogram[min(int(seconds * 1000), SHARED_HISTOGRAM_MS)] += 1
+
+    def totals(self):
+        """ Returns (calls, active, max active, start time) """
+        with self.lock:
+            return self.counts[0], self.counts[1], self.counts[2], self.start_time.value
+
+    def percentiles(self):
+        """ p50 and p99 in seconds, to the nearest ms """
+        with self.lock:
+            histogram = list(self.histogram)
+
+        total = sum(histogram)
+        if total == 0:
+            return 0.0, 0.0
+
+        results = []
+        for pct in (50, 99):
+            wanted = min(total - 1, int(total * pct / 100))
+            seen = 0
+            for ms, count in enumerate(histogram):
+                seen += count
+                if seen > wanted:
+                    results.append(ms / 1000)
+                    break
+        return results[0], results[1]
+
+# SharedCounters of the --workers processes, None when there is one process
+shared = None
+
+def report_shared_stats():
+    """ report_stats() for --workers, run by the parent process """
+    last_count = 0
+    last_time = time.time()
+    while True:
+        time.sleep(STATS_INTERVAL)
+        now = time.time()
+        count, active, max_active, _ = shared.totals()
+        if count != last_count or active > 0:
+            rate = max(0, count - last_count) / (now - last_time)
+            print(f'Requests/sec: {rate:8.1f} | in-flight: {active:5} | max in-flight: {max_active:5}')
+        last_count = count
+        last_time = now
+
+
+# ----------------------------------------------------------------------------
+# The same in every course server (Star Wars, weather, Family Search). Each lesson
+# folder runs on its own, so this is copied instead of imported: change every copy.
+LATENCY_KINDS = ('fixed', 'uniform', 'lognormal')
+
+class LatencyModel:
+    """ How long each request sleeps and how often it fails (--latency options)
+
+    A path starts from the latency of its longest matching prefix in
+    endpoints, or base when none match, then
+        fixed     : always that latency
+        uniform   : anywhere within +/- spread (a fraction) of it
+        lognormal : a long tail with that latency as the median, spread is sigma
+    outlier_rate of the requests sleep another outlier_delay seconds.
+    """
+
+    def __init__(self, base, endpoints=None, kind='fixed', spread=0.5, outlier_rate=0.0, outlier_delay=0.0,
+                 error_rate=0.0, empty_rate=0.0, seed=None):
+        super().__init__()
+        self.base = base
+        self.endpoints = dict(endpoints or {})
+        self.kind = kind
+        self.spread = spread
+        self.outlier_rate = outlier_rate
+        self.outlier_delay = outlier_delay
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def median(self, path):
+        best = None
+        for prefix in self.endpoints:
+            if path.startswith(prefix) and (best == None or len(prefix) > len(best)):
+                best = prefix
+        return self.base if best == None else self.endpoints[best]
+
+    def delay(self, path):
+        """ Seconds to sleep before answering path """
+        median = self.median(path)
+        with self.lock:
+            if self.kind == 'uniform':
+                seconds = self.rand.uniform(median * (1 - self.spread), median * (1 + self.spread))
+            elif self.kind == 'lognormal' and median > 0:
+                seconds = self.rand.lognormvariate(math.log(median), self.spread)
+            else:
+                seconds = median
+
+            if self.outlier_rate > 0 and self.rand.random() < self.outlier_rate:
+                seconds += self.outlier_delay
+
+        return max(seconds, 0.0)
+
+    def fault(self):
+        """ Returns 'error' (reply 500), 'empty' (reply null) or None for a normal reply """
+        if self.error_rate <= 0 and self.empty_rate <= 0:
+            return None
+
+        with self.lock:
+            roll = self.rand.random()
+        if roll < self.error_rate:
+            return 'error'
+        if roll < self.error_rate + self.empty_rate:
+            return 'empty'
+        return None
+
+
+def add_latency_arguments(parser, delay):
+    parser.add_argument('--delay', type=float, default=delay,
+                        help='median latency in seconds of each request')
+    parser.add_argument('--latency', choices=LATENCY_KINDS, default='fixed',
+                        help='how the latency of each request varies around its median')
+    parser.add_argument('--latency-spread', type=float, default=0.5,
+                        help='uniform: +/- this fraction of the median, lognormal: sigma')
+    parser.add_argument('--latency-endpoint', action='append', default=[], metavar='PREFIX=SECONDS',
+                        help='median latency of the paths starting with PREFIX, can be repeated')
+    parser.add_argument('--outlier-rate', type=float, default=0.0,
+                        help='fraction of requests that are slow outliers')
+    parser.add_argument('--outlier-delay', type=float, default=0.0,
+                        help='extra seconds an outlier sleeps')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of data requests answered with a 500 error')
+    parser.add_argument('--empty-rate', type=float, default=0.0,
+                        help='fraction of data requests answered with an empty (null) body')
+    parser.add_argument('--latency-seed', type=int,
+                        help='seed for the latencies and failures, so runs can be repeated')
+
+
+def latency_from_args(args, base, endpoints=None):
+    """ The LatencyModel for the --latency options, --latency-endpoint overrides endpoints """
+    endpoints = dict(endpoints or {})
+    for item in args.latency_endpoint:
+        prefix, _, seconds = item.partition('=')
+        endpoints[prefix] = float(seconds)
+
+    return LatencyModel(base, endpoints, args.latency, args.latency_spread, args.outlier_rate, args.outlier_delay,
+                        args.error_rate, args.empty_rate, args.latency_seed)
+
+# Batches sleep once for the whole batch, see --batch-sleep
+latency = LatencyModel(SLEEP, {'/people/': BATCH_SLEEP, '/families/': BATCH_SLEEP})
+
+# ----------------------------------------------------------------------------
+class Admission:
+    """ Optional back pressure on the person and family requests
+
+    At most max_concurrent requests are handled at once and a token bucket
+    lets rate requests/sec through, with bursts of up to burst requests.
+    0 turns a limit off. A request over a limit is answered 429, or waits for
+    its turn when queue is True. After share() the limits hold for all of the
+    --workers processes together.
+    """
+
+    # Indexes of self.values
+    ACTIVE, TOKENS, LAST_REFILL, REJECTED, QUEUED = range(5)
+
+    def __init__(self, max_concurrent=0, rate=0.0, burst=None, queue=False):
         super().__init__()
-        self.id = id
-        self.name = name
-        self.parents = None
-        self.family = None
-        self.birth = get_date()
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst if burst else max(1.0, rate)
+        self.queue = queue
+        self.cond = threading.Condition()
+        self.values = [0.0] * 5
+        self.reset()
+
+    def share(self):
+        """ Keep the counts in shared memory so every worker enforces the same limits, call before forking """
+        self.cond = multiprocessing.Condition()
+        self.values = multiprocessing.RawArray('d', self.values)
+
+    def reset(self):
+        with self.cond:
+            self.values[self.ACTIVE] = 0
+            self.values[self.TOKENS] = self.burst
+            self.values[self.LAST_REFILL] = time.perf_counter()
+            self.values[self.REJECTED] = 0
+            self.values[self.QUEUED] = 0
+
+    def enabled(self):
+        return self.max_concurrent > 0 or self.rate > 0
+
+    def totals(self):
+        """ Returns (rejected, queued) """
+        with self.cond:
+            return int(self.values[self.REJECTED]), int(self.values[self.QUEUED])
+
+    def _try_admit(self):
+        """ Call with self.cond held. Returns 0 when admitted, else the seconds
+            to wait for a token, or None to wait for a running request to finish """
+        values = self.values
+        if self.max_concurrent > 0 and values[self.ACTIVE] >= self.max_concurrent:
+            return None
 
-    def add_birth(self, date_str):
-        self.birth = date_str
+        if self.rate > 0:
+            # perf_counter() is the same clock in every process
+            now = time.perf_counter()
+            values[self.TOKENS] = min(self.burst, values[self.TOKENS] + (now - values[self.LAST_REFILL]) * self.rate)
+            values[self.LAST_REFILL] = now
+            if values[self.TOKENS] < 1:
+                return (1 - values[self.TOKENS]) / self.rate
+            values[self.TOKENS] -= 1
+
+        values[self.ACTIVE] += 1
+        return 0
+
+    def admit(self):
+        """ Returns True when the request can go ahead, call release() once it is done """
+        with self.cond:
+            wait = self._try_admit()
+            if wait != 0:
+                if not self.queue:
+                    self.values[self.REJECTED] += 1
+                    return False
+                self.values[self.QUEUED] += 1
+            while wait != 0:
+                self.cond.wait(wait)
+                wait = self._try_admit()
+            return True
+
+    async def admit_async(self):
+        """ admit() for the asyncio server, waiting doesn't block the event loop """
+        with self.cond:
+            wait = self._try_admit()
+            if wait != 0:
+                if not self.queue:
+                    self.values[self.REJECTED] += 1
+                    return False
+                self.values[self.QUEUED] += 1
+        while wait != 0:
+            await asyncio.sleep(ADMISSION_POLL if wait == None else wait)
+            with self.cond:
+                wait = self._try_admit()
+        return True
+
+    def release(self):
+        with self.cond:
+            self.values[self.ACTIVE] -= 1
+            self.cond.notify()
+
+# Seconds between checks for a free slot by a queued asyncio request
+ADMISSION_POLL = 0.005
+
+# --max-concurrent, --rate, --burst and --queue
+admission = Admission()
 
-    def add_parents(self, id):
-        self.parents = id
 
-    def add_family(self, id):
-        self.family = id
+# ----------------------------------------------------------------------------
+class People:
+    """ Column store of everyone in the tree, indexed by person id (ids start at 1) """
 
-    def get_dict(self):
+    def __init__(self):
+        super().__init__()
+        # index 0 is a placeholder so the person id is the index.
+        # family ids of 0 mean None
+        self.names = array('H', [0])        # index into NAMES
+        self.births = array('I', [0])       # days since BIRTH_START
+        self.parents = array('I', [0])      # family id of the parents
+        self.families = array('I', [0])     # family id where this person is a husband/wife
+
+    def add(self, name, birth):
+        self.names.append(name)
+        self.births.append(birth)
+        self.parents.append(0)
+        self.families.append(0)
+        return len(self.names) - 1
+
+    def __len__(self):
+        return len(self.names) - 1
+
+    def __contains__(self, id):
+        return 0 < id < len(self.names)
+
+    def get_dict(self, id):
         person_dict = {}
     
-        person_dict["id"] = encode(self.id)
-        person_dict["name"] = self.name
-        person_dict["birth"] = self.birth
-        person_dict["parent_id"] = encode(self.parents)
-        person_dict["family_id"] = encode(self.family)
+        person_dict["id"] = encode(id)
+        person_dict["name"] = NAMES[self.names[id]]
+        person_dict["birth"] = format_birth(self.births[id])
+        person_dict["parent_id"] = encode(self.parents[id] or None)
+        person_dict["family_id"] = encode(self.families[id] or None)
     
         return person_dict
 
-    def __str__(self):
-        output  = f'id        : {encode(self.id)}\n'
-        output += f'name       : {self.name}\n'
-        output += f'birth      : {self.birth}\n'
-        output += f'parent id : {encode(self.parents)}\n'
-        output += f'family id : {encode(self.family)}\n'
-
-        return output
-
 # ----------------------------------------------------------------------------
-class Family:
+class Families:
+    """ Column store of all families, indexed by family id (ids start at 1)
+
+    The children of a family are the person ids first_child to
+    first_child + child_count - 1, followed by extra_child (the husband or wife
+    of the child family, 0 for the starting family).
+    """
 
-    def __init__(self, id, husband, wife):
+    def __init__(self):
         super().__init__()
-        self.id = id
-        self.husband = husband
-        self.wife = wife
-        self.children = []
-
-    def add_child(self, id):
-        self.children.append(id)
-        
-    def get_dict(self):
+        self.husbands = array('I', [0])
+        self.wives = array('I', [0])
+        self.first_child = array('I', [0])
+        self.child_count = array('B', [0])
+        self.extra_child = array('I', [0])
+
+    def add(self, husband, wife, first_child, child_count, extra_child):
+        self.husbands.append(husband)
+        self.wives.append(wife)
+        self.first_child.append(first_child)
+        self.child_count.append(child_count)
+        self.extra_child.append(extra_child)
+        return len(self.husbands) - 1
+
+    def __len__(self):
+        return len(self.husbands) - 1
+
+    def __contains__(self, id):
+        return 0 < id < len(self.husbands)
+
+    def get_children(self, id):
+        first = self.first_child[id]
+        children = list(range(first, first + self.child_count[id]))
+        if self.extra_child[id]:
+            children.append(self.extra_child[id])
+        return children
+
+    def get_dict(self, id):
         family_dict = {}
     
-        family_dict["id"] = encode(self.id)
-        family_dict["husband_id"] = encode(self.husband)
-        family_dict["wife_id"] = encode(self.wife)
-        ids = []
-        for child in self.children:
-            ids.append(encode(child.id))
-        family_dict["children"] = ids
+        family_dict["id"] = encode(id)
+        family_dict["husband_id"] = encode(self.husbands[id])
+        family_dict["wife_id"] = encode(self.wives[id])
+        family_dict["children"] = [encode(child) for child in self.get_children(id)]
     
         return family_dict
 
-    def __str__(self):
-        output  = f'id         : {encode(self.id)}\n'
-        output += f'husband    : {encode(self.husband)}\n'
-        output += f'wife       : {encode(self.wife)}\n'
-        for child in self.children:
-            output += f'  Child    : {encode(child.id)}\n'
+# ----------------------------------------------------------------------------
+class Recorded:
+    """ People or families loaded from a --record file, same lookups as People and Families """
+
+    def __init__(self, records):
+        super().__init__()
+        # records[i] has id encode(i + 1)
+        self.records = [None] + records
+
+    def __len__(self):
+        return len(self.records) - 1
 
-        return output
+    def __contains__(self, id):
+        return 0 < id < len(self.records)
+
+    def get_dict(self, id):
+        return self.records[id]
+
+# The tree being served, replaced by build_tree()
+people = People()
+families = Families()
+
+# Tree from a --record file served by --replay, None to build a new tree at each /start
+replay_tree = None
+REPLAY_LATENCY_MIN = SLEEP
+REPLAY_LATENCY_MAX = SLEEP
+REPLAY_SEED = 0
+
+# Encoded id -> JSON bytes of each person and family, filled by cache_records()
+cache_json = True
+person_json = {}
+family_json = {}
 
 
 # ----------------------------------------------------------------------------
-def build_tree(gens):
+def build_tree(gens, rand=random):
+    """ Every random choice comes from rand, so a seeded random.Random() always gives the same tree """
     global people
     global families
     global log
 
-    people = {}
-    families = {}
+    people = People()
+    families = Families()
 
-    next_person_id = 1
-    next_family_id = 1
-
-    def _create_family(generation):
-        nonlocal next_person_id
-        nonlocal next_family_id
-        
-        # print(f'Generation: {generation}')
-        # print(f'next person / family: {next_person_id} / {next_family_id}')
+    # Families still to create: (generation, id of the person they are the parents of).
+    # Popping the husband's parents before the wife's gives the same id order
+    # as a depth first recursion.
+    todo = [(gens, 0)]
+    while todo:
+        generation, child_id = todo.pop()
         if generation < 1:
-            return
-
-        husband = Person(next_person_id, get_name_male())
-        people[next_person_id] = husband
-        next_person_id += 1
-
-        wife = Person(next_person_id, get_name_female())
-        people[next_person_id] = wife
-        next_person_id += 1
+            continue
 
-        family = Family(next_family_id, husband.id, wife.id)
-        husband.add_family(next_family_id)
-        wife.add_family(next_family_id)
-        families[next_family_id] = family
-        next_family_id += 1
+        husband_id = people.add(get_name_male(rand), get_birth(rand))
+        wife_id = people.add(get_name_female(rand), get_birth(rand))
 
-        number_children = random.randint(2, 8)
+        number_children = rand.randint(2, 8)
+        first_child = len(people) + 1
         for i in range(number_children):
-
-            if random.randint(1, 2) == 1:
-                child = Person(next_person_id, get_name_male())
+            if rand.randint(1, 2) == 1:
+                people.add(get_name_male(rand), get_birth(rand))
             else:
-                child = Person(next_person_id, get_name_female())
+                people.add(get_name_female(rand), get_birth(rand))
 
-            people[next_person_id] = child
-            family.add_child(child)
-            next_person_id += 1
+        family_id = families.add(husband_id, wife_id, first_child, number_children, child_id)
+        people.families[husband_id] = family_id
+        people.families[wife_id] = family_id
+        if child_id:
+            people.parents[child_id] = family_id
 
         if generation > 1:
-            # create parents and recurve calls
-            husband_parents = _create_family(generation - 1)
-            husband.add_parents(husband_parents.id)
-            husband_parents.add_child(husband)
-
-            wife_parents = _create_family(generation - 1)
-            wife.add_parents(wife_parents.id)
-            wife_parents.add_child(wife)
+            todo.append((generation - 1, wife_id))
+            todo.append((generation - 1, husband_id))
 
+    print(f'Number of people  : {len(people)}')
+    print(f'Number of families: {len(families)}')
+    log.write(f'Number of people  : {len(people)}')
+    log.write(f'Number of families: {len(families)}')
 
-        # return the family that was created
-        return family
-
-    _create_family(gens)
+    
+# ----------------------------------------------------------------------------
+def set_encoding(rand):
+    """ Pick PRIME and ID, the ids sent to clients depend on them """
+    global PRIME
+    global ID
+
+    PRIME = rand.choice(primes)
+    ID = rand.randint(10000, 10000000)
+
+
+def save_tree(filename, generations):
+    """ Write the tree made by build_tree() to filename, --replay serves it again """
+    tree = {
+        'generations': generations,
+        'prime': PRIME,
+        'id': ID,
+        'start_family_id': encode(1),
+        'people': [people.get_dict(id) for id in range(1, len(people) + 1)],
+        'families': [families.get_dict(id) for id in range(1, len(families) + 1)],
+    }
+    with open(filename, 'w') as f:
+        json.dump(tree, f)
+
+
+def load_tree(filename):
+    """ Read a --record file, the ids are encoded with the PRIME and ID it was recorded with """
+    global PRIME
+    global ID
+
+    with open(filename) as f:
+        tree = json.load(f)
+    PRIME = tree['prime']
+    ID = tree['id']
+    return tree
+
+
+def restore_tree(tree):
+    """ Serve a tree from load_tree() instead of building a new one """
+    global people
+    global families
 
+    people = Recorded(tree['people'])
+    families = Recorded(tree['families'])
     print(f'Number of people  : {len(people)}')
     print(f'Number of families: {len(families)}')
     log.write(f'Number of people  : {len(people)}')
     log.write(f'Number of families: {len(families)}')
 
+
+# ----------------------------------------------------------------------------
+def get_person(id):
+    global people
+    if id in people:
+        return people.get_dict(id)
+    else:
+        return None
+
+
+def get_family(id):
+    global families
+    if id in families:
+        return families.get_dict(id)
+    else:
+        return None
+
+
+def cache_records():
+    """ Serialize every person and family once, the tree doesn't change until the next /start """
+    global person_json
+    global family_json
+
+    person_json = {encode(id): bytes(json.dumps(people.get_dict(id)), "utf8") for id in range(1, len(people) + 1)}
+    family_json = {encode(id): bytes(json.dumps(families.get_dict(id)), "utf8") for id in range(1, len(families) + 1)}
+
+
+def get_record_json(code, cache, get_record):
+    """ Returns the JSON bytes for an encoded person or family id, None if not found """
+    if cache_json:
+        return cache.get(code)
+
+    data = get_record(decode(code))
+    if data == None:
+        return None
+    return bytes(json.dumps(data), "utf8")
+
+
+def get_batch_codes(ids):
+    """ Returns the list of encoded ids in the <id>,<id>,... of a /people or /families path """
+    codes = ids.split(',')
+    if len(codes) > MAX_BATCH:
+        return None
+
+    try:
+        return list(dict.fromkeys(int(code) for code in codes))
+    except:
+        return None
+
+
+def get_batch_json(codes, cache, get_record):
+    """ Returns the JSON bytes of {id: record, ...}, same format as json.dumps() """
+    items = []
+    for code in codes:
+        data = get_record_json(code, cache, get_record)
+        items.append(b'"%d": %s' % (code, data if data != None else b'null'))
+    return b'{' + b', '.join(items) + b'}'
+
+
+def is_batch(path):
+    return path.startswith('/people/') or path.startswith('/families/')
+
+
+def request_delay(path):
+    if replay_tree != None:
+        # The same path always gets the same latency, whatever order the requests arrive in
+        rand = random.Random(zlib.crc32(bytes(path, 'utf8')) ^ REPLAY_SEED)
+        return rand.uniform(REPLAY_LATENCY_MIN, REPLAY_LATENCY_MAX)
+    return latency.delay(path)
+
+
+def is_data_request(path):
+    """ Person and family requests, as opposed to /, /start and /end """
+    return is_batch(path) or path.startswith(('/person/', '/family/'))
+
+
+def request_fault(path):
+    """ 'error', 'empty' or None, only the person and family requests fail """
+    if is_data_request(path):
+        return latency.fault()
+    return None
+
+
+def request_started(path):
+    """ Returns the start time to pass to request_finished() """
+    global thread_count
+    global lock
+    global max_thread_count
+    global call_count
+    global log
+
+    # In async mode the counts are the number of requests in flight, not threads
+    active = 'requests' if async_mode else 'threads'
+    with lock:
+        thread_count += 1
+        call_count += 1
+        if thread_count > max_thread_count:
+            max_thread_count = thread_count
+        if not quiet:
+            print(f'Current: active {active} / max count: {thread_count} / {max_thread_count}')
+        log.write(f'Current: active {active} / max count: {thread_count} / {max_thread_count}', LOG_REQUESTS)
+
+    if shared != None:
+        shared.started()
+
+    if not quiet:
+        print('- ' * 35)
+        print(f'Request: {path}')
+
+    log.write(f'Request: {path}', LOG_REQUESTS)
+    return time.perf_counter()
+
+
+def request_finished(started, path):
+    global thread_count
+    global lock
+
+    finished = time.perf_counter()
+    stats.add(started, finished, path)
+    if shared != None:
+        shared.finished(finished - started)
+    with lock:
+        thread_count -= 1
+
+
+def get_stats_json():
+    return bytes(json.dumps(stats.export()), "utf8")
+
+
+def create_tree(generations, tree_seed):
+    """ Build the tree served until the next /start, or restore the --replay tree """
+    global generations_created
+    global seed_created
+
+    if replay_tree != None:
+        if generations != replay_tree['generations']:
+            print(f'Replaying the recorded tree, it has {replay_tree["generations"]} generations not {generations}')
+        generations = replay_tree['generations']
+
+    output = f'Creating family tree with {generations} generations...'
+    print(output)
+    log.write(output)
+
+    generations_created = generations
+    seed_created = tree_seed
+    if replay_tree != None:
+        restore_tree(replay_tree)
+    else:
+        build_tree(generations, random.Random(tree_seed))
+    if cache_json:
+        cache_records()
+
+
+def reply_root():
+    start_id = 1 # random.randint(1, 100000)
+    data = {"start_family_id" : encode(start_id)}
+    return bytes(json.dumps(data), "utf8")
+
+
+def reply_start(generations, tree_seed=None):
+    """ /start/<generations> or /start/<generations>/<seed> """
+    global thread_count
+    global max_thread_count
+    global call_count
+    global family_request_order
+    global start_time
+
+    family_request_order = []
+    if tree_seed == None:
+        tree_seed = seed
+
+    if shared == None:
+        create_tree(generations, tree_seed)
+    elif replay_tree == None and generations != generations_created:
+        # The workers share the tree built before they started, it can't be rebuilt
+        output = f'The server was started with --generations {generations_created}, /start asked for {generations}'
+        print(output)
+        log.write(output)
+        return None
+    elif replay_tree == None and tree_seed != seed_created:
+        output = f'The server was started with --seed {seed_created}, /start asked for seed {tree_seed}'
+        print(output)
+        log.write(output)
+        return None
+
+    max_thread_count = 1
+    thread_count = 1
+    call_count = 1
+
+    stats.reset()
+    admission.reset()
+    if shared != None:
+        shared.reset()
+    start_time = time.time()
+
+    return b'{"status":"OK"}'
+
+
+def reply_end():
+    print('#' * 80)
+    log.write('#' * 80)
+
+    # with --workers the totals of every worker, not just this one
+    calls, max_count, began = call_count, max_thread_count, start_time
+    if shared != None:
+        calls, _, max_count, began = shared.totals()
+
+    print(f'Total number of people  : {len(people)}')
+    print(f'Total number of families: {len(families)}')
+    print(f'Number of generations   : {generations_created}')
+    log.write(f'Total number of people  : {len(people)}')
+    log.write(f'Total number of families: {len(families)}')
+    log.write(f'Number of generations   : {generations_created}')
+
+
+    title = 'Families were requested in this order:' if shared == None else 'Families this worker was asked for, in order:'
+    print(title)
+    log.write(title)
     
+    output = str(family_request_order)[1:-1]
+    print(output)
+    log.write(output)
+
+    print(f'Total number of API calls: {calls}')
+    log.write(f'Total number of API calls: {calls}')
+
+    active = 'in-flight requests' if async_mode else 'thread count'
+    print(f'Final {active} (max count): {max_count}')
+    log.write(f'Final {active} (max count): {max_count}')
+
+    total_time = time.time() - began
+    p50, p99 = stats.percentiles() if shared == None else shared.percentiles()
+
+    print(f'Calls per second / p50 / p99: {calls / total_time:.1f} / {p50 * 1000:.1f} ms / {p99 * 1000:.1f} ms')
+    log.write(f'Calls per second / p50 / p99: {calls / total_time:.1f} / {p50 * 1000:.1f} ms / {p99 * 1000:.1f} ms')
+
+    # with --workers the requests limited by every worker, the counts are shared
+    rejected, queued = admission.totals()
+
+    if admission.enabled():
+        print(f'Rejected (429) / queued requests: {rejected} / {queued}')
+        log.write(f'Rejected (429) / queued requests: {rejected} / {queued}')
+
+    data = {
+        'status': 'OK', 'people': len(people), 'families': len(families), 'api': calls, 'threads': max_count,
+        'total_time': total_time, 'calls_per_second': calls / total_time, 'p50': p50, 'p99': p99,
+        'rejected': rejected, 'queued': queued,
+    }
+    json_data = bytes(json.dumps(data), "utf8")
+
+    print('#' * 80)
+    log.write('#' * 80)
+
+    return json_data
+
+
+def reply_person(code):
+    return get_record_json(code, person_json, get_person)
+
+
+def reply_family(code):
+    family_request_order.append(decode(code))
+    return get_record_json(code, family_json, get_family)
+
+
+def reply_people(ids):
+    codes = get_batch_codes(ids)
+    if codes == None:
+        return None
+    return get_batch_json(codes, person_json, get_person)
+
+
+def reply_families(ids):
+    codes = get_batch_codes(ids)
+    if codes == None:
+        return None
+    family_request_order.extend(decode(code) for code in codes)
+    return get_batch_json(codes, family_json, get_family)
+
+
 # ----------------------------------------------------------------------------
-class Handler(BaseHTTPRequestHandler):
+# The same in every course server (Star Wars, weather, Family Search). Each lesson
+# folder runs on its own, so this is copied instead of imported: change every copy.
+class Router:
+    """ Table of path templates such as '/person/{id:int}' to handlers
+
+    Only the first segment of a template is fixed, the rest are {fields}.
+    A path is looked up by its first segment and number of segments (one
+    dict access), then the :int fields are converted and the fields are
+    passed to the handler in order. A path that matches no template, or has
+    a bad :int field, has no route, so the server only needs one 404 path.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.routes = {}
+
+    def add(self, template, handler):
+        parts = template.strip('/').split('/')
+        int_fields = []
+        for index, part in enumerate(parts[1:]):
+            if not (part.startswith('{') and part.endswith('}')):
+                raise ValueError(f'Only the first segment of {template} can be fixed')
+            if part.endswith(':int}'):
+                int_fields.append(index)
+        self.routes[(parts[0], len(parts))] = (handler, tuple(int_fields))
+
+    def match(self, path):
+        """ Returns (handler, [field values]), None when no template matches """
+        if '?' in path:
+            path = path[:path.index('?')]
+        parts = path.strip('/').split('/')
+        route = self.routes.get((parts[0], len(parts)))
+        if route == None:
+            return None
 
-    def get_person(self, id):
-        global people
-        if id in people:
-            return people[id].get_dict()
-        else:
+        handler, int_fields = route
+        args = parts[1:]
+        try:
+            for index in int_fields:
+                args[index] = int(args[index])
+        except ValueError:
             return None
+        return handler, args
 
 
-    def get_family(self, id):
-        global families
-        if id in families:
-            return families[id].get_dict()
-        else:
-            return None
- 
-    def do_GET(self):
-        global thread_count
-        global lock
-        global max_thread_count
-        global call_count
-        global family_request_order
-        global log
-        global generations_created
+router = Router()
+router.add('/', reply_root)
+router.add('/start/{generations:int}', reply_start)
+router.add('/start/{generations:int}/{seed:int}', reply_start)
+router.add('/end', reply_end)
+router.add('/person/{id:int}', reply_person)
+router.add('/family/{id:int}', reply_family)
+router.add('/people/{ids}', reply_people)
+router.add('/families/{ids}', reply_families)
 
-        with lock:
-            thread_count += 1
-            call_count += 1
-            if thread_count > max_thread_count:
-                max_thread_count = thread_count
-            print(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
-            log.write(f'Current: active threads / max count: {thread_count} / {max_thread_count}')
 
-        print('- ' * 35)
-        print(f'Request: {self.path}')
-
-        log.write(f'Request: {self.path}')
-
-        if SLEEP > 0:
-            time.sleep(SLEEP)
-
-        if 'start' in self.path:
-            family_request_order = []
-            parts = self.path.split('/')
-            if len(parts) < 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+def create_response(path):
+    """ Returns the JSON bytes to send for this path, None for a 404 """
+    route = router.match(path)
+    if route == None:
+        return None
 
-            try:
-                generations = int(parts[-1])
-            except:
-                generations = MAX_GENERATIONS
-
-            output = f'Creating family tree with {generations} generations...'
-            print(output)
-            log.write(output)
-
-            generations_created = generations
-            build_tree(generations)
-
-            max_thread_count = 1
-            thread_count = 1
-            call_count = 1
-
-            json_data = '{"status":"OK"}'
-
-                    
-        elif 'end' in self.path:
-            print('#' * 80)
-            log.write('#' * 80)
-
-            print(f'Total number of people  : {len(people)}')
-            print(f'Total number of families: {len(families)}')
-            print(f'Number of generations   : {generations_created}')
-            log.write(f'Total number of people  : {len(people)}')
-            log.write(f'Total number of families: {len(families)}')
-            log.write(f'Number of generations   : {generations_created}')
-
-
-            print('Families were requested in this order:')
-            log.write('Families were requested in this order:')
-            
-            output = str(family_request_order)[1:-1]
-            print(output)
-            log.write(output)
-
-            print(f'Total number of API calls: {call_count}')
-            log.write(f'Total number of API calls: {call_count}')
-
-            print(f'Final thread count (max count): {max_thread_count}')
-            log.write(f'Final thread count (max count): {max_thread_count}')
-
-            data_str = '{' + \
-                       f'"status":"OK", "people": {len(people)}, "families": {len(families)}, "api": {call_count}, "threads": {max_thread_count}' + \
-                       '}'
-            json_data = json.dumps(ast.literal_eval(data_str))
-
-            print('#' * 80)
-            log.write('#' * 80)
-
-        elif 'person' in self.path or 'family' in self.path:
-            parts = self.path.split('/')
-            # print('****************************')
-            # print(parts)
-
-            if len(parts) < 3:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+    handler, args = route
+    json_data = handler(*args)
 
-            try:
-                id = decode(int(parts[-1]))
-            except:
-                id = None
-
-            if id == None:
-                self.send_response(404)
-                self.send_header("Content-type",  "application/json")
-                self.end_headers()
-                with lock:
-                    thread_count -= 1
-                return
+    if json_data != None:
+        if not quiet:
+            print('Sending:', json_data.decode())
+        if log.level >= LOG_PAYLOADS:
+            log.write(f'Sending: {json_data.decode()}', LOG_PAYLOADS)
 
-            if 'person' in self.path:
-                data = self.get_person(id)
-            else:
-                data = self.get_family(id)
-                family_request_order.append(id)
+    return json_data
 
-            if data != None:
-                json_data = json.dumps(data)
-            else:
-                json_data = None
-        else:
-            start_id = 1 # random.randint(1, 100000)
-            data = {"start_family_id" : encode(start_id)}
-            json_data = json.dumps(data)
 
+# ----------------------------------------------------------------------------
+class Handler(BaseHTTPRequestHandler):
+
+    # HTTP/1.0 closes the connection after each reply, --keep-alive switches to HTTP/1.1
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, format, *args):
+        # BaseHTTPRequestHandler prints every request to stderr
+        if not quiet:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(get_stats_json())
+            return
+
+        limited = admission.enabled() and is_data_request(self.path)
+        if limited and not admission.admit():
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        started = request_started(self.path)
+        try:
+            delay = request_delay(self.path)
+            if delay > 0:
+                time.sleep(delay)
+
+            fault = request_fault(self.path)
+            if fault == 'error':
+                self.send_error(500)
+                return
+
+            json_data = b'null' if fault == 'empty' else create_response(self.path)
+            self.send_json(json_data)
+        finally:
+            request_finished(started, self.path)
+            if limited:
+                admission.release()
+
+    def send_json(self, json_data):
+        """ Send the JSON bytes, or a 404 when json_data is None """
         if json_data == None:
             self.send_response(404)
             self.send_header("Content-type",  "application/json")
+            self.send_header("Content-Length", "0")
             self.end_headers()
         else:
-            print('Sending:', json_data)
-            log.write(f'Sending: {json_data}')
-
             self.send_response(200)
             self.send_header("Content-type",  "application/json")
+            self.send_header("Content-Length", str(len(json_data)))
             self.end_headers()
-            self.wfile.write(bytes(json_data, "utf8"))
-
-        with lock:
-            thread_count -= 1
+            self.wfile.write(json_data)
 
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+    request_queue_size = LISTEN_BACKLOG
+
+
+# ----------------------------------------------------------------------------
+def format_response(status, json_data, persistent):
+    """ Returns the bytes of a full HTTP response for the asyncio server """
+    version = 'HTTP/1.1' if keep_alive else 'HTTP/1.0'
+    body = json_data if json_data != None else b''
+    connection = 'keep-alive' if persistent else 'close'
+    head = f'{version} {status}\r\nContent-type: application/json\r\nContent-Length: {len(body)}\r\nConnection: {connection}\r\n\r\n'
+    return bytes(head, 'latin-1') + body
+
+
+async def handle_async_request(reader, writer):
+    """ Serve the HTTP requests of one connection on the event loop, using asyncio.sleep() for the latency """
+    try:
+        while True:
+            if keep_alive:
+                request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT)
+            else:
+                request_line = await reader.readline()
+            if not request_line:
+                break
+
+            # Only the Connection header is used
+            connection = ''
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'connection':
+                    connection = value.strip().lower()
+
+            parts = request_line.decode('latin-1').split()
+            if len(parts) < 3 or parts[0] != 'GET':
+                writer.write(format_response('405 Method Not Allowed', None, False))
+                await writer.drain()
+                break
+
+            # Same rules as BaseHTTPRequestHandler
+            path, version = parts[1], parts[2]
+            if version == 'HTTP/1.1':
+                persistent = keep_alive and connection != 'close'
+            else:
+                persistent = keep_alive and connection == 'keep-alive'
+
+            if path == '/stats':
+                writer.write(format_response('200 OK', get_stats_json(), persistent))
+                await writer.drain()
+                if not persistent:
+                    break
+                continue
+
+            limited = admission.enabled() and is_data_request(path)
+            if limited and not await admission.admit_async():
+                writer.write(format_response('429 Too Many Requests', None, persistent))
+                await writer.drain()
+                if not persistent:
+                    break
+                continue
+
+            started = request_started(path)
+            try:
+                delay = request_delay(path)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                fault = request_fault(path)
+                json_data = b'null' if fault == 'empty' else create_response(path)
+            finally:
+                request_finished(started, path)
+                if limited:
+                    admission.release()
+
+            if fault == 'error':
+                writer.write(format_response('500 Internal Server Error', None, persistent))
+            elif json_data == None:
+                writer.write(format_response('404 Not Found', None, persistent))
+            else:
+                writer.write(format_response('200 OK', json_data, persistent))
+            await writer.drain()
+
+            if not persistent:
+                break
+
+    except (ConnectionError, asyncio.TimeoutError):
+        pass
+
+    except asyncio.CancelledError:
+        # <Ctrl-C> cancels the connections still open, often idle keep-alive ones.
+        # Python 3.11 prints a traceback for every handler that ends cancelled,
+        # so the connection just ends here, closed by the finally.
+        pass
+
+    finally:
+        writer.close()
+
+
+async def serve_async(reuse_port=False):
+    server = await asyncio.start_server(handle_async_request, hostName, serverPort, backlog=LISTEN_BACKLOG,
+                                        reuse_port=reuse_port)
+    async with server:
+        await server.serve_forever()
+
+
+# ----------------------------------------------------------------------------
+def serve(use_async):
+    """ Serve requests until <Ctrl-C> """
+    global async_mode
+
+    if use_async:
+        async_mode = True
+        try:
+            asyncio.run(serve_async(reuse_port=shared != None))
+        except KeyboardInterrupt:
+            pass
+    else:
+        server = ThreadingSimpleServer((hostName, serverPort), Handler)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def run_workers(count, use_async):
+    """ Fork count processes that all listen on serverPort (SO_REUSEPORT), the
+        kernel spreads the connections over them. Waits for them to stop. """
+    global log
+
+    pids = []
+    for number in range(1, count + 1):
+        pid = os.fork()
+        if pid == 0:
+            # Every worker writes its own log
+            level, flush_interval, flush_size = log.level, log.flush_interval, log.flush_size
+            log = Log(f'server-{number}.log', level)
+            log.flush_interval = flush_interval
+            log.flush_size = flush_size
+            # SIGTERM from the parent stops the worker like <Ctrl-C>, so its log is closed
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            try:
+                serve(use_async)
+            finally:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                log.close()
+                os._exit(0)
+        pids.append(pid)
+
+    # Forking a process that has threads can deadlock, so the parent's threads start now
+    log.start()
+    if quiet:
+        threading.Thread(target=report_shared_stats, daemon=True).start()
+
+    # SIGTERM is handled like <Ctrl-C>: every worker is told to stop, then waited for
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        # The signal may only have reached this process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
 
 if __name__ == '__main__':
     # random.seed(101)
@@ -454,8 +1462,115 @@ if __name__ == '__main__':
     # for id in families:
     #     print(families[id])
 
-    server = ThreadingSimpleServer((hostName, serverPort), Handler)
-    print('Starting Family Search server, use <Ctrl-C> or <Command-C> to stop')
-    print(f'URL = {hostName}:{serverPort}\n')
-    server.serve_forever()
-
+    parser = argparse.ArgumentParser(description='Family Search server')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='serve all requests from one asyncio event loop instead of a thread per request')
+    parser.add_argument('--batch-sleep', type=float, default=BATCH_SLEEP,
+                        help='latency in seconds charged once per /people or /families batch')
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='payloads',
+                        help='how much of each request is written to server.log')
+    parser.add_argument('--log-flush-interval', type=float, default=LOG_FLUSH_INTERVAL,
+                        help='seconds between writes of server.log')
+    parser.add_argument('--log-flush-size', type=int, default=LOG_FLUSH_SIZE,
+                        help='write server.log early once this many lines are waiting')
+    parser.add_argument('--quiet', action='store_true',
+                        help='no printing per request, print a stats line every --stats-interval seconds')
+    parser.add_argument('--stats-interval', type=float, default=STATS_INTERVAL,
+                        help='seconds between stats lines in quiet mode')
+    parser.add_argument('--no-cache', dest='cache_json', action='store_false',
+                        help='build the JSON for every request instead of serializing the tree once at /start')
+    parser.add_argument('--keep-alive', action='store_true',
+                        help='use HTTP/1.1 persistent connections so clients can reuse sockets')
+    parser.add_argument('--seed', type=int,
+                        help='pick PRIME and ID from this seed and build the same tree at every /start without a seed, '
+                             'with --workers a /start with a different seed gets a 404')
+    parser.add_argument('--record', metavar='FILE',
+                        help='write a tree of --generations generations to FILE and exit')
+    parser.add_argument('--generations', type=int, default=MAX_GENERATIONS,
+                        help='number of generations written by --record, or built at startup with --workers')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='serve the tree in a --record FILE at every /start instead of a new random tree')
+    parser.add_argument('--replay-latency', type=float, nargs=2, metavar=('MIN', 'MAX'),
+                        default=(REPLAY_LATENCY_MIN, REPLAY_LATENCY_MAX),
+                        help='with --replay, each path sleeps a fixed time picked between MIN and MAX seconds')
+    parser.add_argument('--replay-seed', type=int, default=REPLAY_SEED,
+                        help='with --replay, changes which latency each path gets')
+    parser.add_argument('--max-concurrent', type=int, default=0,
+                        help='answer 429 (or queue) when this many person/family requests are running, '
+                             'counted over all --workers, 0 for no limit')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='token bucket limit on person/family requests per second over all --workers, 0 for no limit')
+    parser.add_argument('--burst', type=float, default=0.0,
+                        help='token bucket size, defaults to --rate')
+    parser.add_argument('--queue', action='store_true',
+                        help='requests over --max-concurrent or --rate wait for their turn instead of getting a 429')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes serving the port, with more than 1 the tree of '
+                             '--generations generations (and --seed) is built once at startup and /start only resets '
+                             'the counts, a /start asking for other generations or another seed gets a 404')
+    add_latency_arguments(parser, SLEEP)
+    args = parser.parse_args()
+
+    if args.seed != None:
+        seed = args.seed
+        set_encoding(random.Random(seed))
+
+    if args.record:
+        build_tree(args.generations, random.Random(seed))
+        save_tree(args.record, args.generations)
+        print(f'Recorded {args.generations} generations to {args.record}')
+        sys.exit(0)
+
+    if args.replay:
+        # A replayed path always sleeps its --replay-latency, these options would be ignored
+        ignored = [flag for flag in ('--delay', '--batch-sleep', '--latency', '--latency-spread', '--latency-endpoint',
+                                     '--outlier-rate', '--outlier-delay')
+                   if getattr(args, flag[2:].replace('-', '_')) != parser.get_default(flag[2:].replace('-', '_'))]
+        if ignored:
+            parser.error(f'{", ".join(ignored)} can\'t be used with --replay, use --replay-latency instead')
+
+        replay_tree = load_tree(args.replay)
+        REPLAY_LATENCY_MIN, REPLAY_LATENCY_MAX = args.replay_latency
+        REPLAY_SEED = args.replay_seed
+        print(f'Replaying {args.replay}: {replay_tree["generations"]} generations, '
+              f'{REPLAY_LATENCY_MIN}-{REPLAY_LATENCY_MAX} seconds per request')
+
+    BATCH_SLEEP = args.batch_sleep
+    latency = latency_from_args(args, args.delay, {'/people/': BATCH_SLEEP, '/families/': BATCH_SLEEP})
+    admission = Admission(args.max_concurrent, args.rate, args.burst, args.queue)
+    cache_json = args.cache_json
+    # With --workers the writer thread is only started once the workers are forked
+    log = Log('server.log', LOG_LEVELS[args.log_level], start=args.workers <= 1)
+    log.flush_interval = args.log_flush_interval
+    log.flush_size = args.log_flush_size
+    quiet = args.quiet
+    STATS_INTERVAL = args.stats_interval
+
+    if args.keep_alive:
+        keep_alive = True
+        Handler.protocol_version = 'HTTP/1.1'
+        Handler.timeout = KEEP_ALIVE_TIMEOUT
+        # the headers and body go out in separate writes, without TCP_NODELAY the
+        # body waits for the delayed ACK of the headers (~40 ms) on a reused connection
+        Handler.disable_nagle_algorithm = True
+        # don't wait for idle connections when the server is stopped
+        ThreadingSimpleServer.daemon_threads = True
+
+    if args.workers > 1:
+        shared = SharedCounters()
+        admission.share()
+        ThreadingSimpleServer.allow_reuse_port = True
+        create_tree(args.generations, seed)
+        print(f'Starting Family Search server ({args.workers} workers), use <Ctrl-C> or <Command-C> to stop')
+        print(f'URL = {hostName}:{serverPort}\n')
+        run_workers(args.workers, args.use_async)
+    else:
+        if quiet:
+            threading.Thread(target=report_stats, daemon=True).start()
+        if args.use_async:
+            print('Starting Family Search server (asyncio), use <Ctrl-C> or <Command-C> to stop')
+            print(f'URL = {hostName}:{serverPort}\n')
+        else:
+            print('Starting Family Search server, use <Ctrl-C> or <Command-C> to stop')
+            print(f'URL = {hostName}:{serverPort}\n')
+        serve(args.use_async)